@@ -1,5 +1,6 @@
 from django.contrib import admin
 
-from bot.models import Bot
+from bot.models import Bot, Deployment
 
 admin.site.register(Bot)
+admin.site.register(Deployment)
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import docker
+from django.conf import settings
+
+from utils.redis import redis_client
+
+# docker host url (None for the environment's host) -> client, time of last use
+_clients: Dict[Optional[str], Tuple[docker.DockerClient, float]] = {}
+_clients_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def _create_client(base_url: Optional[str]) -> docker.DockerClient:
+    options = {
+        "timeout": settings.DOCKER_TIMEOUT,
+        "max_pool_size": settings.DOCKER_MAX_POOL_SIZE,
+    }
+    if base_url is None:
+        return docker.from_env(**options)
+    return docker.DockerClient(base_url=base_url, **options)
+
+
+def get_client(base_url: Optional[str] = None) -> docker.DockerClient:
+    """
+    Returns the client of the docker host, clients are created once per process and
+    keep their connections open. A client unused for DOCKER_HEALTHCHECK_INTERVAL
+    seconds is pinged first and replaced if its daemon does not answer.
+    """
+    global _clients_pid
+    with _lock:
+        if _clients_pid != os.getpid():
+            # a forked worker must not share the connections of its parent
+            _clients.clear()
+            _clients_pid = os.getpid()
+
+        client, used_at = _clients.get(base_url, (None, 0.0))
+        now = time.monotonic()
+        if client is not None and now - used_at > settings.DOCKER_HEALTHCHECK_INTERVAL:
+            try:
+                client.ping()
+            except Exception:
+                client.close()
+                client = None
+        if client is None:
+            client = _create_client(base_url)
+
+        _clients[base_url] = (client, now)
+        return client
+
+
+def get_bot_docker_host(bot_id: int) -> Optional[str]:
+    """
+    Returns the docker host running the bot, bots are spread over DOCKER_HOSTS and
+    stay on the host they were first deployed to when hosts are added.
+    """
+    hosts = settings.DOCKER_HOSTS
+    if not hosts:
+        return None
+
+    key = f"docker::host::{bot_id}"
+    redis_client.set(key, hosts[bot_id % len(hosts)], nx=True)
+    return redis_client.get(key).decode()
+
+
+def get_bot_client(bot_id: int) -> docker.DockerClient:
+    return get_client(get_bot_docker_host(bot_id))
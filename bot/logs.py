@@ -0,0 +1,104 @@
+import calendar
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from docker.models.containers import Container
+
+# lines longer than this are split, a bot printing without newlines can not grow
+# the buffer without a bound
+MAX_LINE_LENGTH = 64 * 1024
+
+# docker timestamp of the line, RFC 3339 with nanoseconds, and the line
+LogLine = Tuple[str, str]
+
+
+def _split_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        yield from lines
+        while len(buffer) > MAX_LINE_LENGTH:
+            yield buffer[:MAX_LINE_LENGTH]
+            buffer = buffer[MAX_LINE_LENGTH:]
+    if buffer:
+        yield buffer
+
+
+def _parse_line(raw: bytes) -> LogLine:
+    timestamp, _, line = raw.decode("utf-8", errors="replace").partition(" ")
+    return timestamp, line.rstrip("\r")
+
+
+def cursor_since(cursor: str) -> int:
+    """Unix time of the second of the cursor, docker filters logs by whole seconds."""
+    return calendar.timegm(time.strptime(cursor[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def read_logs(
+    container: Container,
+    limit: int,
+    since: Optional[float] = None,
+    cursor: Optional[str] = None,
+) -> Tuple[List[LogLine], bool]:
+    """
+    Reads at most limit lines of the container log, the last ones or the first ones
+    after since or the cursor, and tells whether more lines follow them.
+    """
+    if since is None and cursor is None:
+        logs = container.logs(tail=limit, timestamps=True)
+        return [_parse_line(raw) for raw in _split_lines([logs])], False
+
+    if cursor is not None:
+        since = max(since or 0, cursor_since(cursor))
+    # docker follows streamed logs unless told otherwise, the stream ends at the last
+    # line written so far
+    stream = container.logs(stream=True, follow=False, timestamps=True, since=since)
+    lines: List[LogLine] = []
+    try:
+        for raw in _split_lines(stream):
+            timestamp, line = _parse_line(raw)
+            # lines of the second of the cursor are sent again by docker
+            if cursor is not None and timestamp <= cursor:
+                continue
+            if len(lines) == limit:
+                return lines, True
+            lines.append((timestamp, line))
+    finally:
+        stream.close()
+    return lines, False
+
+
+def iter_log_events(
+    container: Container,
+    limit: int,
+    since: Optional[float] = None,
+    cursor: Optional[str] = None,
+) -> Iterator[str]:
+    """
+    Server-sent events of the container log, new lines are polled for every
+    BOT_LOG_POLL_INTERVAL seconds until BOT_LOG_STREAM_TIMEOUT. Event ids are
+    cursors, so reconnecting clients continue after the last line they got.
+    """
+    start = int(time.time())
+    deadline = time.monotonic() + settings.BOT_LOG_STREAM_TIMEOUT
+
+    lines, has_more = read_logs(container, limit, since, cursor)
+    while True:
+        for timestamp, line in lines:
+            yield f"id: {timestamp}\ndata: {line}\n\n"
+        if lines:
+            cursor = lines[-1][0]
+        else:
+            if cursor is None and since is None:
+                # the log was empty, follow it from when the stream started
+                since = start
+            # comments keep proxies from closing an idle connection
+            yield ": keepalive\n\n"
+
+        if time.monotonic() >= deadline:
+            return
+        if not has_more:
+            time.sleep(settings.BOT_LOG_POLL_INTERVAL)
+        lines, has_more = read_logs(container, limit, since, cursor)
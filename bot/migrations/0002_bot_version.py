@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 02:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="bot",
+            name="version",
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.1.7 on 2026-10-18 02:41
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bot", "0002_bot_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Deployment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("task_id", models.CharField(max_length=255, unique=True)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("queued", "Queued"),
+                            ("generating", "Generating"),
+                            ("building", "Building"),
+                            ("swapping", "Swapping"),
+                            ("succeeded", "Succeeded"),
+                            ("unchanged", "Unchanged"),
+                            ("failed", "Failed"),
+                        ],
+                        default="queued",
+                        max_length=16,
+                    ),
+                ),
+                ("mode", models.CharField(blank=True, default="", max_length=16)),
+                ("code_hash", models.CharField(blank=True, default="", max_length=64)),
+                ("image_id", models.CharField(blank=True, default="", max_length=255)),
+                (
+                    "container_id",
+                    models.CharField(blank=True, default="", max_length=255),
+                ),
+                ("error", models.TextField(blank=True, default="")),
+                ("queued_at", models.DateTimeField(auto_now_add=True)),
+                ("started_at", models.DateTimeField(blank=True, null=True)),
+                ("generated_at", models.DateTimeField(blank=True, null=True)),
+                ("built_at", models.DateTimeField(blank=True, null=True)),
+                ("finished_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "bot",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="deployments",
+                        to="bot.bot",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Deployment",
+                "verbose_name_plural": "Deployments",
+                "db_table": "deployment",
+                "ordering": ["-id"],
+            },
+        ),
+    ]
@@ -1,5 +1,8 @@
+import hashlib
+
 from django.contrib.postgres.fields import ArrayField
 from django.db import models
+from django.db.models import F
 
 
 class Bot(models.Model):
@@ -14,6 +17,8 @@ class Bot(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # bumped on every write that changes the generated code or the schema of the bot
+    version = models.PositiveIntegerField(default=1)
 
     class Meta:
         db_table = "bot"
@@ -22,3 +27,61 @@ class Bot(models.Model):
 
     def __str__(self) -> str:
         return self.name
+
+    @classmethod
+    def bump_version(cls, bot_id: int) -> None:
+        cls.objects.filter(pk=bot_id).update(version=F("version") + 1)
+
+    @property
+    def webhook_path(self) -> str:
+        """Path updates of this bot are posted to, derived from its token."""
+        return f"/{hashlib.sha256(self.token.encode()).hexdigest()[:32]}"
+
+
+class Deployment(models.Model):
+    class Status(models.TextChoices):
+        QUEUED = "queued", "Queued"
+        GENERATING = "generating", "Generating"
+        BUILDING = "building", "Building"
+        SWAPPING = "swapping", "Swapping"
+        SUCCEEDED = "succeeded", "Succeeded"
+        UNCHANGED = "unchanged", "Unchanged"
+        FAILED = "failed", "Failed"
+
+    bot = models.ForeignKey(
+        Bot,
+        on_delete=models.CASCADE,
+        related_name="deployments",
+    )
+    task_id = models.CharField(max_length=255, unique=True)
+    status = models.CharField(
+        max_length=16,
+        choices=Status.choices,
+        default=Status.QUEUED,
+    )
+    mode = models.CharField(max_length=16, blank=True, default="")
+    code_hash = models.CharField(max_length=64, blank=True, default="")
+    image_id = models.CharField(max_length=255, blank=True, default="")
+    container_id = models.CharField(max_length=255, blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    queued_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    generated_at = models.DateTimeField(null=True, blank=True)
+    built_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = "deployment"
+        verbose_name = "Deployment"
+        verbose_name_plural = "Deployments"
+        ordering = ["-id"]
+
+    def __str__(self) -> str:
+        return f"{self.bot_id} {self.status}"
+
+    def advance(self, status: str, **fields: object) -> None:
+        """Moves the deployment to the given status, saving only the given fields."""
+        self.status = status
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.save(update_fields=["status", *fields])
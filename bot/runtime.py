@@ -0,0 +1,78 @@
+import functools
+import re
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+TEMPLATES_DIR = Path(__file__).resolve().parent / "bot_templates"
+
+# runtime name -> template of the code running the dispatcher
+RUNTIMES = {
+    "polling": "polling.txt",
+    "webhook": "webhook.txt",
+    "uvloop": "uvloop.txt",
+    "stream": "stream.txt",
+}
+
+# storage name -> template of the FSM storage and user data store of the bots
+STORAGES = {
+    "memory": "memory_storage.txt",
+    "redis": "redis_storage.txt",
+}
+
+# only upper case names are slots, any other brace is kept as it is
+SLOT_PATTERN = re.compile(r"\{([A-Z_]+)\}")
+
+
+class RuntimeTemplate:
+    """
+    A bot template split once into static segments and the named slots between them,
+    rendering it is a join without any parsing.
+    """
+
+    def __init__(self, source: str) -> None:
+        self.segments: List[str] = []
+        self.slots: List[str] = []
+
+        position = 0
+        for match in SLOT_PATTERN.finditer(source):
+            self.segments.append(source[position : match.start()])
+            self.slots.append(match.group(1))
+            position = match.end()
+        self.segments.append(source[position:])
+
+    def _render(self, start: int, end: int, values: Dict[str, str]) -> str:
+        parts = [self.segments[start]]
+        for index in range(start, end):
+            slot = self.slots[index]
+            if slot not in values:
+                raise KeyError(f"Missing value for template slot {slot}")
+            parts.append(values[slot])
+            parts.append(self.segments[index + 1])
+        return "".join(parts)
+
+    def render(self, **values: str) -> str:
+        return self._render(0, len(self.slots), values)
+
+    def split(self, slot: str, **values: str) -> Tuple[str, str]:
+        """Renders the parts of the template before and after the given slot."""
+        index = self.slots.index(slot)
+        return (
+            self._render(0, index, values),
+            self._render(index + 1, len(self.slots), values),
+        )
+
+
+@functools.cache
+def get_runtime_template(runtime: str, storage: str) -> RuntimeTemplate:
+    """Loads the template of the given runtime and storage once per process."""
+    if runtime not in RUNTIMES:
+        raise ValueError(f"Unknown bot runtime: {runtime}")
+    if storage not in STORAGES:
+        raise ValueError(f"Unknown bot storage: {storage}")
+
+    base = (TEMPLATES_DIR / "main.txt").read_text()
+    runtime_code = (TEMPLATES_DIR / RUNTIMES[runtime]).read_text()
+    storage_code = (TEMPLATES_DIR / STORAGES[storage]).read_text()
+    return RuntimeTemplate(
+        base.replace("{STORAGE}", storage_code).replace("{RUNTIME}", runtime_code),
+    )
@@ -0,0 +1,119 @@
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator
+
+from django.conf import settings
+from redis.exceptions import WatchError
+
+from utils.redis import redis_client
+
+DEPLOY_QUEUE_KEY = "deploy::queue"
+DEPLOY_STAGES = ("queue", "generate", "build", "swap")
+
+
+def _builds_key(host: str) -> str:
+    return f"deploy::builds::{host}"
+
+
+def _stage_key(stage: str) -> str:
+    return f"deploy::stage::{stage}"
+
+
+def queue_deploy(bot_id: int) -> None:
+    """Adds the bot to the deploy queue, a bot already waiting keeps its place."""
+    redis_client.zadd(DEPLOY_QUEUE_KEY, {bot_id: time.time()}, nx=True)
+
+
+def dequeue_deploy(bot_id: int) -> None:
+    """Removes the bot from the deploy queue and records how long it waited."""
+    queued_at = redis_client.zscore(DEPLOY_QUEUE_KEY, bot_id)
+    redis_client.zrem(DEPLOY_QUEUE_KEY, bot_id)
+    if queued_at is not None:
+        record_stage("queue", time.time() - queued_at)
+
+
+def record_stage(stage: str, duration: float) -> None:
+    pipeline = redis_client.pipeline()
+    pipeline.hincrby(_stage_key(stage), "count", 1)
+    pipeline.hincrbyfloat(_stage_key(stage), "total", duration)
+    pipeline.hset(_stage_key(stage), "last", duration)
+    pipeline.execute()
+
+
+@contextmanager
+def timed_stage(stage: str) -> Iterator[None]:
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.monotonic() - start)
+
+
+@contextmanager
+def build_slot(host: str) -> Iterator[None]:
+    """
+    Holds one of the DEPLOY_MAX_CONCURRENT_BUILDS build slots of the docker host while
+    building an image. Slots are scored by the time they were taken, so the slots of
+    crashed workers expire after DEPLOY_BUILD_TIMEOUT.
+    """
+    key = _builds_key(host)
+    token = str(uuid.uuid4())
+    deadline = time.monotonic() + settings.DEPLOY_BUILD_WAIT_TIMEOUT
+
+    while True:
+        now = time.time()
+        redis_client.zremrangebyscore(key, 0, now - settings.DEPLOY_BUILD_TIMEOUT)
+        with redis_client.pipeline() as pipeline:
+            try:
+                pipeline.watch(key)
+                if pipeline.zcard(key) < settings.DEPLOY_MAX_CONCURRENT_BUILDS:
+                    pipeline.multi()
+                    pipeline.zadd(key, {token: now})
+                    pipeline.execute()
+                    break
+            except WatchError:
+                continue
+        if time.monotonic() > deadline:
+            raise RuntimeError(
+                f"No build slot of {host} was free "
+                f"after {settings.DEPLOY_BUILD_WAIT_TIMEOUT}s",
+            )
+        time.sleep(1)
+
+    try:
+        yield
+    finally:
+        redis_client.zrem(key, token)
+
+
+def get_metrics() -> dict:
+    builds_keys = list(redis_client.scan_iter(_builds_key("*")))
+    pipeline = redis_client.pipeline()
+    pipeline.zcard(DEPLOY_QUEUE_KEY)
+    for key in builds_keys:
+        pipeline.zcard(key)
+    for stage in DEPLOY_STAGES:
+        pipeline.hgetall(_stage_key(stage))
+    queue_depth, *results = pipeline.execute()
+    builds, stages = results[: len(builds_keys)], results[len(builds_keys) :]
+
+    running_builds = {
+        key.decode().removeprefix(_builds_key("")): count
+        for key, count in zip(builds_keys, builds)
+        if count
+    }
+
+    durations = {}
+    for stage, values in zip(DEPLOY_STAGES, stages):
+        count = int(values.get(b"count", 0))
+        durations[stage] = {
+            "count": count,
+            "average": float(values[b"total"]) / count if count else None,
+            "last": float(values[b"last"]) if count else None,
+        }
+    return {
+        "queue_depth": queue_depth,
+        "running_builds": running_builds,
+        "stages": durations,
+    }
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from bot.models import Bot
+from bot.models import Bot, Deployment
 
 
 class MyBotsResponseSerializer(serializers.ModelSerializer):
@@ -21,3 +21,40 @@ class CreateBotResponseSerializer(serializers.ModelSerializer):
     class Meta:
         model = Bot
         fields = ["id", "name", "description", "created_at", "token"]
+
+
+class DeploymentSerializer(serializers.ModelSerializer):
+    durations = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Deployment
+        fields = [
+            "id",
+            "task_id",
+            "status",
+            "mode",
+            "code_hash",
+            "image_id",
+            "container_id",
+            "error",
+            "queued_at",
+            "started_at",
+            "generated_at",
+            "built_at",
+            "finished_at",
+            "durations",
+        ]
+
+    def get_durations(self, obj: Deployment) -> dict:
+        """Seconds spent in every finished stage of the deployment."""
+        stages = [
+            ("queue", obj.queued_at, obj.started_at),
+            ("generate", obj.started_at, obj.generated_at),
+            ("build", obj.generated_at, obj.built_at),
+            ("swap", obj.built_at or obj.generated_at, obj.finished_at),
+        ]
+        return {
+            stage: (end - start).total_seconds()
+            for stage, start, end in stages
+            if start is not None and end is not None
+        }
@@ -1,50 +1,397 @@
-import black
+import contextlib
+import functools
+import hashlib
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework.exceptions import ValidationError
 
 from bot.models import Bot
-from component.telegram.models import Component
+from bot.runtime import get_runtime_template
+from bot.updates import updates_stream_key
+from component.cache import (
+    CODEGEN_CACHE_VERSION,
+    component_hash,
+    get_snippets,
+    set_snippets,
+)
+from component.emitter import CodeEmitter, format_code
+from component.graph import ComponentGraph
+from component.models import Component
+from utils.redis import redis_client
 
 
-def generate_code(bot: Bot) -> str:
-    components = Component.objects.filter(
-        bot_id=bot.id,
-        component_type=Component.ComponentType.TRIGGER,
-    )
-    bot_component_codes = []
-    raw_state_check = ""
-    for component in components:
-        if component.component_content_type.model != "onmessage":
+def _generate_snippet(component: Component, graph: ComponentGraph) -> str:
+    code = component.generate_code(graph, CodeEmitter())
+    if code and settings.CODEGEN_BLACK_FORMAT:
+        code = format_code(code)
+    return code.strip("\n")
+
+
+# graph of the bot being generated, set once in every worker of the process pool
+_worker_graph: Optional[ComponentGraph] = None
+
+
+def _init_worker(graph: ComponentGraph) -> None:
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _generate_partition_in_worker(pks: List[int]) -> Dict[int, str]:
+    return {pk: _generate_snippet(_worker_graph.get(pk), _worker_graph) for pk in pks}
+
+
+def _generate_partitions(
+    graph: ComponentGraph,
+    partitions: List[List[Component]],
+) -> Iterator[Dict[int, str]]:
+    """
+    Yields the snippets of every partition in order. With enough partitions they are
+    generated on a process pool, as generation is pure CPU work once the graph is
+    loaded, unless this process is daemonic and can not start one.
+    """
+    workers = settings.CODEGEN_WORKERS
+    if (
+        workers < 2
+        or len(partitions) < settings.CODEGEN_PARALLEL_MIN_TRIGGERS
+        # celery prefork workers are daemonic, they are not allowed to have children
+        or multiprocessing.current_process().daemon
+    ):
+        for partition in partitions:
+            yield {
+                component.pk: _generate_snippet(component, graph)
+                for component in partition
+            }
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(graph,),
+    ) as executor:
+        # map yields in submission order, so the file stays deterministic
+        yield from executor.map(
+            _generate_partition_in_worker,
+            [[component.pk for component in partition] for partition in partitions],
+            chunksize=max(len(partitions) // (workers * 4), 1),
+        )
+
+
+def _iter_component_codes(
+    graph: ComponentGraph,
+    partitions: List[List[Component]],
+) -> Iterator[Tuple[Component, str]]:
+    """
+    Yields the formatted code of every component of the given partitions, only the
+    components whose cached snippet is missing or stale are generated again.
+    """
+    hashes = {
+        component.pk: component_hash(component, graph)
+        for partition in partitions
+        for component in partition
+    }
+    cached = get_snippets(hashes)
+    missing = [
+        [component for component in partition if component.pk not in cached]
+        for partition in partitions
+    ]
+
+    for partition, codes in zip(partitions, _generate_partitions(graph, missing)):
+        # snippets are cached as their partition is done, so only one partition of
+        # generated code is held at a time
+        set_snippets(codes, hashes)
+        for component in partition:
+            yield component, cached.get(component.pk, codes.get(component.pk))
+
+
+def _collect_components(graph: ComponentGraph) -> List[List[Component]]:
+    """
+    Returns the components reachable from every trigger, partitioned by the trigger
+    reaching them first.
+    """
+    # memo of the functions emitted in this generation, every component reachable
+    # from several triggers is generated once and referenced by its function name
+    emitted: Dict[int, str] = {}
+    partitions = []
+    for component in graph.triggers():
+        if component._meta.model_name != "onmessage":
             raise ValidationError(
-                "Only OnMessage trigger components are supported. you requested {component.__class__.__name__}",
+                f"Only OnMessage trigger components are supported. you requested {component.__class__.__name__}",
             )
+        partitions.append(graph.all_linked_components(component, emitted))
+    return partitions
 
-        for next_component in component.get_all_next_components():
-            object = next_component.component_content_type.model_class().objects.get(
-                pk=next_component.pk,
-            )
-            code_result = object.generate_code()
-            if isinstance(code_result, tuple):
-                keyboard, callback_code = code_result
-                if keyboard:
-                    bot_component_codes.append(keyboard)
-                if callback_code:
-                    bot_component_codes.append(callback_code)
-            else:
-                if "raw_state" in code_result:
-                    raw_state_check += code_result + "\n"
-                else:
-                    bot_component_codes.append(code_result)
-
-    if raw_state_check:
-        bot_component_codes.append(raw_state_check)
-
-    with open("bot/bot_templates/main.txt") as f:
-        base = f.read()
-
-    code = base.format(
-        FUNCTION_CODES="\n\n".join(bot_component_codes),
+
+def _render_template(bot: Bot, runtime: str, storage: str) -> Tuple[str, str]:
+    """Returns the parts of the bot template before and after the function codes."""
+    return get_runtime_template(runtime, storage).split(
+        "FUNCTION_CODES",
         TOKEN=bot.token,
         BASE_URL=settings.BALE_API_URL,
+        WEBHOOK_URL=f"{settings.BOT_WEBHOOK_BASE_URL}{bot.webhook_path}",
+        WEBHOOK_PATH=bot.webhook_path,
+        UPDATES_STREAM=updates_stream_key(bot.id),
+        REDIS_URL=settings.BOT_REDIS_URL,
+        USER_DATA_TTL=str(settings.BOT_USER_DATA_TTL),
+        USER_DATA_MAX_USERS=str(settings.BOT_USER_DATA_MAX_USERS),
+        USER_DATA_MAX_KEYS=str(settings.BOT_USER_DATA_MAX_KEYS),
+        USER_DATA_MAX_VALUE_SIZE=str(settings.BOT_USER_DATA_MAX_VALUE_SIZE),
+    )
+
+
+def _iter_chunks(
+    graph: ComponentGraph,
+    partitions: List[List[Component]],
+    header: str,
+    footer: str,
+) -> Iterator[str]:
+    yield header
+
+    separator = ""
+    raw_state_codes = []
+    for component, code in _iter_component_codes(graph, partitions):
+        if not code:
+            continue
+        # handlers filtering on the state go after every other handler
+        if "raw_state" in code:
+            raw_state_codes.append(code)
+            continue
+        yield separator + code
+        separator = "\n\n\n"
+
+    for code in raw_state_codes:
+        yield separator + code
+        separator = "\n\n\n"
+
+    yield footer
+
+
+def _iter_graph_code(
+    bot: Bot,
+    graph: ComponentGraph,
+    runtime: str,
+    storage: str,
+) -> Iterator[str]:
+    partitions = _collect_components(graph)
+    header, footer = _render_template(bot, runtime, storage)
+    return _iter_chunks(graph, partitions, header, footer)
+
+
+def iter_code(
+    bot: Bot,
+    runtime: str | None = None,
+    storage: str | None = None,
+) -> Iterator[str]:
+    """
+    Returns the code of the bot as chunks: the template header, the function of each
+    component as soon as it is generated and the template footer. Errors of the
+    components are raised as ValidationError, those of the graph before the first
+    chunk and those of a component when its chunk is reached.
+    """
+    with _validation_errors():
+        graph = ComponentGraph.load(bot.id)
+        chunks = _iter_graph_code(
+            bot,
+            graph,
+            runtime or settings.BOT_RUNTIME,
+            storage or settings.BOT_STORAGE,
+        )
+    return _iter_validated(chunks)
+
+
+def _iter_validated(chunks: Iterator[str]) -> Iterator[str]:
+    with _validation_errors():
+        yield from chunks
+
+
+def generate_code(
+    bot: Bot,
+    runtime: str | None = None,
+    storage: str | None = None,
+) -> str:
+    return "".join(iter_code(bot, runtime, storage))
+
+
+def _artifact_key(bot_id: int, fingerprint: str) -> str:
+    return f"codegen::bot::{bot_id}::{fingerprint}"
+
+
+def _artifact_error_key(bot_id: int, fingerprint: str) -> str:
+    return f"codegen::error::{bot_id}::{fingerprint}"
+
+
+# settings the generated code depends on besides the components of the bot
+CODE_SETTINGS = (
+    "BALE_API_URL",
+    "SITE_URL",
+    "BOT_WEBHOOK_BASE_URL",
+    "BOT_REDIS_URL",
+    "BOT_USER_DATA_TTL",
+    "BOT_USER_DATA_MAX_USERS",
+    "BOT_USER_DATA_MAX_KEYS",
+    "BOT_USER_DATA_MAX_VALUE_SIZE",
+    "CODEGEN_BLACK_FORMAT",
+)
+
+
+@functools.cache
+def _template_hash(runtime: str, storage: str, setting_values: tuple) -> str:
+    """Hash of the template and the settings the code is rendered with."""
+    template = get_runtime_template(runtime, storage)
+    digest = hashlib.sha256()
+    digest.update(json.dumps([template.segments, template.slots]).encode())
+    digest.update(json.dumps(setting_values, default=str).encode())
+    return digest.hexdigest()[:12]
+
+
+def code_fingerprint(
+    bot: Bot,
+    runtime: str | None = None,
+    storage: str | None = None,
+) -> str:
+    """
+    Identifies the generated code of the bot by its version, runtime and storage, and
+    by the template and the settings it is rendered with.
+    """
+    runtime = runtime or settings.BOT_RUNTIME
+    storage = storage or settings.BOT_STORAGE
+    template_hash = _template_hash(
+        runtime,
+        storage,
+        tuple(getattr(settings, name) for name in CODE_SETTINGS),
+    )
+    return (
+        f"{bot.version}-{runtime}-{storage}-{CODEGEN_CACHE_VERSION}" f"-{template_hash}"
+    )
+
+
+def get_code_artifact(bot: Bot, fingerprint: str) -> Optional[str]:
+    code = redis_client.get(_artifact_key(bot.id, fingerprint))
+    return code.decode() if code is not None else None
+
+
+def get_code_artifact_error(bot: Bot, fingerprint: str) -> Optional[List[str]]:
+    """Returns the validation errors of the last generation of this fingerprint."""
+    error = redis_client.get(_artifact_error_key(bot.id, fingerprint))
+    return json.loads(error) if error is not None else None
+
+
+def _as_validation_error(error: Exception) -> Optional[ValidationError]:
+    """The error as a ValidationError when it is caused by the components of the bot."""
+    if isinstance(error, ValidationError):
+        return error
+    if isinstance(error, DjangoValidationError):
+        return ValidationError(error.messages)
+    if isinstance(error, ObjectDoesNotExist):
+        return ValidationError(str(error))
+    return None
+
+
+@contextlib.contextmanager
+def _validation_errors() -> Iterator[None]:
+    """Raises the errors caused by the components of the bot as ValidationError."""
+    try:
+        yield
+    except Exception as e:
+        error = _as_validation_error(e)
+        if error is None or error is e:
+            raise
+        raise error from e
+
+
+def _check_syntax(code: str) -> None:
+    """Rejects generated code that would not run, instead of deploying it."""
+    try:
+        compile(code, "bot.py", "exec")
+    except SyntaxError as e:
+        raise ValidationError(
+            f"Generated code is invalid: {e.msg} at line {e.lineno}: {(e.text or '').strip()}",
+        )
+
+
+def stream_code(
+    bot: Bot,
+    runtime: str | None = None,
+    storage: str | None = None,
+) -> Iterator[str]:
+    """
+    Returns the chunks of iter_code for a response that is sent while they are
+    generated. Errors of the graph are raised before the first chunk, once the
+    response has started a component error or invalid code can not change its status
+    any more: the file ends with a statement raising the error instead, so it does
+    not run cut short. Other errors cut the response off.
+    """
+    chunks = iter_code(bot, runtime, storage)
+
+    def checked() -> Iterator[str]:
+        code = []
+        try:
+            for chunk in chunks:
+                code.append(chunk)
+                yield chunk
+            _check_syntax("".join(code))
+        except ValidationError as e:
+            details = e.detail if isinstance(e.detail, list) else [e.detail]
+            message = "Code generation failed: " + " ".join(map(str, details))
+            yield f"\n\nraise RuntimeError({message!r})\n"
+
+    return checked()
+
+
+def build_code_artifact(
+    bot: Bot,
+    runtime: str | None = None,
+    storage: str | None = None,
+) -> Tuple[str, str]:
+    """
+    Generates the code of the bot and stores it under the fingerprint of the bot
+    version it was generated from, returns the fingerprint and the code.
+    """
+    runtime = runtime or settings.BOT_RUNTIME
+    storage = storage or settings.BOT_STORAGE
+    fingerprint = code_fingerprint(bot, runtime, storage)
+
+    try:
+        graph = ComponentGraph.load(bot.id)
+        code = "".join(_iter_graph_code(bot, graph, runtime, storage))
+        _check_syntax(code)
+    except Exception as e:
+        # the error is stored for any failure so polling for the code ends, errors
+        # not caused by the bot are kept only until the generation may be retried
+        error = _as_validation_error(e)
+        redis_client.set(
+            _artifact_error_key(bot.id, fingerprint),
+            json.dumps(
+                error.detail if error else [f"Code generation failed: {e}"],
+            ),
+            ex=(
+                settings.CODEGEN_ARTIFACT_TTL if error else settings.CODEGEN_PENDING_TTL
+            ),
+        )
+        if error is None or error is e:
+            raise
+        raise error from e
+
+    redis_client.set(
+        _artifact_key(bot.id, fingerprint),
+        code,
+        ex=settings.CODEGEN_ARTIFACT_TTL,
     )
-    return black.format_str(code, mode=black.Mode())
+    return fingerprint, code
+
+
+def get_or_build_code_artifact(
+    bot: Bot,
+    runtime: str | None = None,
+    storage: str | None = None,
+) -> Tuple[str, str]:
+    fingerprint = code_fingerprint(bot, runtime, storage)
+    code = get_code_artifact(bot, fingerprint)
+    if code is None:
+        return build_code_artifact(bot, runtime, storage)
+    return fingerprint, code
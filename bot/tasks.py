@@ -1,64 +1,738 @@
+import hashlib
+import io
 import logging
-import os
-import shutil
+import tarfile
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
 
 import docker
-from celery import shared_task
+from celery import Task, shared_task
+from django.conf import settings
+from django.utils import timezone
 
-from bot.models import Bot
+from bot.docker_client import get_bot_client, get_client
+from bot.models import Bot, Deployment
+from bot.runtime import TEMPLATES_DIR
+from bot.scheduler import build_slot, dequeue_deploy, queue_deploy, timed_stage
+from bot.services import build_code_artifact, get_or_build_code_artifact
+from bot.updates import updates_offset_key
+from component.models import CodeComponent
+from utils.redis import bot_redis_client, redis_client
 
 logger = logging.getLogger(__name__)
 
 
+def _pending_key(bot_id: int, runtime: str, storage: str) -> str:
+    return f"codegen::pending::{bot_id}::{runtime}::{storage}"
+
+
 @shared_task
-def deploy_bot(bot_id: int, code: str) -> dict:
+def generate_bot_code(bot_id: int, runtime: str, storage: str | None = None) -> dict:
+    storage = storage or settings.BOT_STORAGE
     try:
-        dockerfile_dir = f"./factory/{bot_id}"
-        os.makedirs(dockerfile_dir, exist_ok=True)
-        dockerfile_path = shutil.copyfile(
-            "bot/bot_templates/Dockerfile.txt",
-            f"{dockerfile_dir}/Dockerfile",
-        )
-        pythonfile_path = os.path.join(dockerfile_dir, "main.py")
+        bot = Bot.objects.get(id=bot_id)
+        fingerprint, _ = build_code_artifact(bot, runtime, storage)
+        return {"status": "success", "fingerprint": fingerprint}
+    except Exception as e:
+        logger.error(f"Code generation error for bot {bot_id}: {e}")
+        return {"status": "error", "message": str(e)}
+    finally:
+        redis_client.delete(_pending_key(bot_id, runtime, storage))
 
-        with open(pythonfile_path, "w") as f:
-            f.write(code)
 
-        client = docker.from_env()
-        container_name = f"bot-container-{bot_id}"
+def _enqueue_once(
+    task: Task,
+    pending_key: str,
+    args: list,
+    ttl: int,
+    before_send: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    Sends the task unless one sent with the same pending key is still pending,
+    returns the id of the task doing the work. `before_send` is called with the id
+    of a new task before it is sent.
+    """
+    task_id = str(uuid.uuid4())
+    if not redis_client.set(pending_key, task_id, nx=True, ex=ttl):
+        pending_task_id = redis_client.get(pending_key)
+        if pending_task_id is not None:
+            return pending_task_id.decode()
+        redis_client.set(pending_key, task_id, ex=ttl)
+
+    if before_send is not None:
+        before_send(task_id)
+    task.apply_async(args=args, task_id=task_id)
+    return task_id
+
+
+def enqueue_generate_bot_code(bot_id: int, runtime: str, storage: str) -> str:
+    """
+    Starts generating the code of the bot unless a generation of it is already
+    pending, returns the id of the task building the code.
+    """
+    return _enqueue_once(
+        generate_bot_code,
+        _pending_key(bot_id, runtime, storage),
+        [bot_id, runtime, storage],
+        settings.CODEGEN_PENDING_TTL,
+    )
+
+
+def _deploy_pending_key(bot_id: int) -> str:
+    return f"deploy::pending::{bot_id}"
+
+
+def enqueue_deploy_bot(bot_id: int) -> Deployment:
+    """
+    Queues a deploy of the bot. A deploy still waiting in the queue deploys the latest
+    version of the bot once it starts, so later requests are coalesced into it and
+    get its deployment.
+    """
+    queue_deploy(bot_id)
+    task_id = _enqueue_once(
+        deploy_bot,
+        _deploy_pending_key(bot_id),
+        [bot_id],
+        settings.DEPLOY_PENDING_TTL,
+        before_send=lambda task_id: Deployment.objects.create(
+            bot_id=bot_id,
+            task_id=task_id,
+        ),
+    )
+    deployment, _ = Deployment.objects.get_or_create(
+        task_id=task_id,
+        defaults={"bot_id": bot_id},
+    )
+    return deployment
+
+
+BOT_DOCKERFILE = "Dockerfile.txt"
+RUNTIME_DOCKERFILE = "runtime.Dockerfile.txt"
+# files of the templates directory the runtime image is built from
+RUNTIME_IMAGE_FILES = (
+    RUNTIME_DOCKERFILE,
+    "runner.txt",
+    "host.txt",
+    "ingress.txt",
+    "gateway.txt",
+)
+
+# created by the generated bots once they are started, see main.txt
+READY_FILE = "/tmp/ready"
+
+# resource limits of every bot container
+CONTAINER_OPTIONS = {
+    "privileged": True,
+    "cpu_count": 1,
+    "cpu_shares": 100,
+    "mem_limit": "100m",
+}
 
-        # Build the Docker image
-        client.images.build(
-            path=dockerfile_dir,
-            dockerfile="Dockerfile",
-            tag=f"bot-{bot_id}",
-        )
 
-        # Handle existing container
+def _runtime_image_tag() -> str:
+    digest = hashlib.sha256()
+    for name in RUNTIME_IMAGE_FILES:
+        digest.update((TEMPLATES_DIR / name).read_bytes())
+    return f"{settings.BOT_RUNTIME_IMAGE}:{digest.hexdigest()[:12]}"
+
+
+def _ensure_runtime_image(client: docker.DockerClient) -> str:
+    """
+    Returns the tag of the runtime image bot images are built on, building it when
+    missing. The tag is derived from the files the image is built from, so changing
+    the bot dependencies or the runner builds a new version of the image.
+    """
+    tag = _runtime_image_tag()
+    try:
+        client.images.get(tag)
+        return tag
+    except docker.errors.ImageNotFound:
+        pass
+
+    # deploys of several bots may start together, only one of them builds the image
+    with redis_client.lock(
+        f"docker::build::{client.api.base_url}::{tag}",
+        timeout=60 * 10,
+    ):
         try:
-            existing_container = client.containers.get(container_name)
-            existing_container.stop()
-            existing_container.remove()
-        except Exception as e:
-            logger.error(
-                f"Container '{container_name}' does not exist. Proceeding to create a new one. error: {e}",
+            client.images.get(tag)
+        except docker.errors.ImageNotFound:
+            logger.info(f"Building runtime image {tag}")
+            with build_slot(client.api.base_url):
+                client.images.build(
+                    path=str(TEMPLATES_DIR),
+                    dockerfile=RUNTIME_DOCKERFILE,
+                    tag=tag,
+                    rm=True,
+                )
+    return tag
+
+
+def _archive(files: Dict[str, bytes]) -> bytes:
+    """An in-memory tar archive of the files, keyed by their path in the archive."""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def _code_archive(code: str, name: str = "main.py") -> bytes:
+    """A tar archive holding the code as a single file, as expected by put_archive."""
+    return _archive({name: code.encode()})
+
+
+def _build_context(code: str) -> io.BytesIO:
+    """The build context of a bot image, nothing of it is written to disk."""
+    return io.BytesIO(
+        _archive(
+            {
+                "Dockerfile": (TEMPLATES_DIR / BOT_DOCKERFILE).read_bytes(),
+                "main.py": code.encode(),
+            },
+        ),
+    )
+
+
+def _reload_bot(
+    client: docker.DockerClient,
+    bot_id: int,
+    code: str,
+) -> docker.models.containers.Container:
+    """
+    Deploys the code without building an image: a running container of the current
+    runtime image gets the new main.py and reloads it on SIGHUP, otherwise a new
+    container of the runtime image is created with the code.
+    """
+    container_name = f"bot-container-{bot_id}"
+    runtime_image = _ensure_runtime_image(client)
+    archive = _code_archive(code)
+
+    try:
+        container = client.containers.get(container_name)
+    except docker.errors.NotFound:
+        container = None
+
+    if (
+        container is not None
+        and container.status == "running"
+        and container.attrs["Config"]["Image"] == runtime_image
+    ):
+        container.put_archive("/app", archive)
+        container.kill(signal="SIGHUP")
+        return container
+
+    if container is not None:
+        container.remove(force=True)
+    container = client.containers.create(
+        runtime_image,
+        name=container_name,
+        network=settings.BOT_NETWORK,
+        **CONTAINER_OPTIONS,
+    )
+    container.put_archive("/app", archive)
+    container.start()
+    return container
+
+
+HOST_BOTS_DIR = "/app/bots"
+
+
+def _host_key(bot_id: int) -> str:
+    return f"deploy::host::{bot_id}"
+
+
+def _host_bots_key(host: str) -> str:
+    return f"deploy::host::{host}::bots"
+
+
+def _assign_host(bot_id: int) -> str:
+    """Returns the shared host of the bot, assigning it to the first host with room."""
+    host = redis_client.get(_host_key(bot_id))
+    if host is not None:
+        return host.decode()
+
+    for index in range(settings.BOT_HOST_COUNT):
+        host = f"bot-host-{index}"
+        if redis_client.scard(_host_bots_key(host)) < settings.BOT_HOST_CAPACITY:
+            break
+    else:
+        raise RuntimeError("Every shared bot host is full")
+
+    pipeline = redis_client.pipeline()
+    pipeline.set(_host_key(bot_id), host)
+    pipeline.sadd(_host_bots_key(host), bot_id)
+    pipeline.execute()
+    return host
+
+
+def _ensure_service_container(
+    client: docker.DockerClient,
+    name: str,
+    command: List[str],
+    **options: Any,
+) -> docker.models.containers.Container:
+    """Returns the running container of the service, replacing an outdated one."""
+    runtime_image = _ensure_runtime_image(client)
+    try:
+        container = client.containers.get(name)
+        if (
+            container.status == "running"
+            and container.attrs["Config"]["Image"] == runtime_image
+        ):
+            return container
+        container.remove(force=True)
+    except docker.errors.NotFound:
+        pass
+
+    return client.containers.run(
+        runtime_image,
+        command,
+        detach=True,
+        name=name,
+        network=settings.BOT_NETWORK,
+        restart_policy={"Name": "unless-stopped"},
+        **options,
+    )
+
+
+def _ensure_host_container(
+    client: docker.DockerClient,
+    host: str,
+) -> docker.models.containers.Container:
+    # the bots of a host are kept in a volume, they survive a new runtime image
+    return _ensure_service_container(
+        client,
+        host,
+        ["python", "host.py"],
+        volumes={f"{host}-bots": {"bind": HOST_BOTS_DIR, "mode": "rw"}},
+        mem_limit=settings.BOT_HOST_MEM_LIMIT,
+    )
+
+
+def _deploy_to_shared_host(
+    client: docker.DockerClient,
+    bot_id: int,
+    code: str,
+) -> docker.models.containers.Container:
+    """
+    Deploys the bot as a module of a shared host process, which runs many bots in
+    one event loop and loads the new code on SIGHUP.
+    """
+    try:
+        client.containers.get(f"bot-container-{bot_id}").remove(force=True)
+    except docker.errors.NotFound:
+        pass
+
+    container = _ensure_host_container(client, _assign_host(bot_id))
+    container.put_archive(HOST_BOTS_DIR, _code_archive(code, f"{bot_id}.py"))
+    container.kill(signal="SIGHUP")
+    return container
+
+
+def _release_shared_host(bot_id: int) -> None:
+    """Stops the bot on its shared host, if it was deployed to one."""
+    host = redis_client.get(_host_key(bot_id))
+    if host is None:
+        return
+    host = host.decode()
+
+    try:
+        container = get_client().containers.get(host)
+        container.exec_run(["rm", "-f", f"{HOST_BOTS_DIR}/{bot_id}.py"])
+        container.kill(signal="SIGHUP")
+    except docker.errors.NotFound:
+        pass
+
+    pipeline = redis_client.pipeline()
+    pipeline.delete(_host_key(bot_id))
+    pipeline.srem(_host_bots_key(host), bot_id)
+    pipeline.execute()
+
+
+INGRESS_NAME = "bot-ingress"
+INGRESS_ROUTES_DIR = "/app/routes"
+# port the webhook server of bot containers and shared hosts listens on
+WEBHOOK_PORT = 8080
+
+
+def _ensure_network(client: docker.DockerClient) -> None:
+    """Creates the network bots and the ingress reach each other by name on."""
+    with redis_client.lock(f"docker::network::{client.api.base_url}", timeout=60):
+        if not client.networks.list(names=[settings.BOT_NETWORK]):
+            client.networks.create(settings.BOT_NETWORK, driver="bridge")
+
+
+def _ensure_ingress(client: docker.DockerClient) -> docker.models.containers.Container:
+    # routes are kept in a volume, they survive a new runtime image
+    return _ensure_service_container(
+        client,
+        INGRESS_NAME,
+        ["python", "ingress.py"],
+        ports={f"{WEBHOOK_PORT}/tcp": settings.BOT_INGRESS_PORT},
+        volumes={"bot-ingress-routes": {"bind": INGRESS_ROUTES_DIR, "mode": "rw"}},
+    )
+
+
+def _route_key(bot_id: int) -> str:
+    return f"deploy::route::{bot_id}"
+
+
+def _route_webhook(client: docker.DockerClient, bot: Bot, container_name: str) -> None:
+    """Points the webhook path of the bot at the container serving its updates."""
+    ingress = _ensure_ingress(client)
+    target = f"http://{container_name}:{WEBHOOK_PORT}"
+    ingress.put_archive(
+        INGRESS_ROUTES_DIR,
+        _archive({bot.webhook_path.lstrip("/"): target.encode()}),
+    )
+    ingress.kill(signal="SIGHUP")
+    # a route of another token or docker host is left over from an older deployment
+    route = {"base_url": client.api.base_url, "path": bot.webhook_path}
+    previous = redis_client.hgetall(_route_key(bot.id))
+    if previous and {k.decode(): v.decode() for k, v in previous.items()} != route:
+        _release_webhook(bot.id)
+    redis_client.hset(_route_key(bot.id), mapping=route)
+
+
+def _release_webhook(bot_id: int) -> None:
+    """Removes the ingress route of the bot, if its updates were routed."""
+    route = redis_client.hgetall(_route_key(bot_id))
+    if not route:
+        return
+
+    try:
+        ingress = get_client(route[b"base_url"].decode()).containers.get(INGRESS_NAME)
+        path = route[b"path"].decode().lstrip("/")
+        ingress.exec_run(["rm", "-f", f"{INGRESS_ROUTES_DIR}/{path}"])
+        ingress.kill(signal="SIGHUP")
+    except docker.errors.NotFound:
+        pass
+
+    redis_client.delete(_route_key(bot_id))
+
+
+@shared_task
+def release_webhook(bot_id: int) -> None:
+    """Stops routing the updates of a bot that was deleted or got a new token."""
+    _release_webhook(bot_id)
+
+
+GATEWAY_NAME = "bot-gateway"
+GATEWAY_TOKENS_DIR = "/app/tokens"
+
+
+def _ensure_gateway(client: docker.DockerClient) -> docker.models.containers.Container:
+    # tokens are kept in a volume, they survive a new runtime image
+    return _ensure_service_container(
+        client,
+        GATEWAY_NAME,
+        ["python", "gateway.py"],
+        environment={
+            "BALE_API_URL": settings.BALE_API_URL,
+            "REDIS_URL": settings.BOT_REDIS_URL,
+            "UPDATES_STREAM_MAXLEN": settings.UPDATES_STREAM_MAXLEN,
+            "UPDATES_MAX_BACKLOG": settings.UPDATES_MAX_BACKLOG,
+        },
+        volumes={"bot-gateway-tokens": {"bind": GATEWAY_TOKENS_DIR, "mode": "rw"}},
+    )
+
+
+def _gateway_key(bot_id: int) -> str:
+    return f"deploy::gateway::{bot_id}"
+
+
+def _poll_with_gateway(client: docker.DockerClient, bot: Bot) -> None:
+    """Makes the gateway poll the updates of the bot into its update stream."""
+    gateway = _ensure_gateway(client)
+    gateway.put_archive(GATEWAY_TOKENS_DIR, _archive({str(bot.id): bot.token.encode()}))
+    gateway.kill(signal="SIGHUP")
+    redis_client.set(_gateway_key(bot.id), client.api.base_url)
+
+
+def _release_gateway(bot_id: int) -> None:
+    """Stops the gateway polling the updates of the bot, if it was polling them."""
+    base_url = redis_client.get(_gateway_key(bot_id))
+    if base_url is None:
+        return
+
+    try:
+        gateway = get_client(base_url.decode()).containers.get(GATEWAY_NAME)
+        gateway.exec_run(["rm", "-f", f"{GATEWAY_TOKENS_DIR}/{bot_id}"])
+        gateway.kill(signal="SIGHUP")
+    except docker.errors.NotFound:
+        pass
+
+    # the offset belongs to the token that was polled, a new one starts over
+    bot_redis_client.delete(updates_offset_key(bot_id))
+    redis_client.delete(_gateway_key(bot_id))
+
+
+@shared_task
+def release_gateway(bot_id: int) -> None:
+    """Stops polling a bot that was deleted or got a new token."""
+    _release_gateway(bot_id)
+
+
+def _deployed_key(bot_id: int) -> str:
+    return f"deploy::deployed::{bot_id}"
+
+
+def _deploy_hash(code: str, mode: str) -> str:
+    """Hash of everything a deployment is made of, equal hashes run the same bot."""
+    digest = hashlib.sha256()
+    digest.update(mode.encode())
+    digest.update(_runtime_image_tag().encode())
+    digest.update((TEMPLATES_DIR / "Dockerfile.txt").read_bytes())
+    digest.update(code.encode())
+    return digest.hexdigest()
+
+
+def _is_deployed(
+    client: docker.DockerClient,
+    bot_id: int,
+    deploy_hash: str,
+    mode: str,
+) -> bool:
+    """Whether the deployment of this hash is the one currently running."""
+    deployed_hash = redis_client.get(_deployed_key(bot_id))
+    if deployed_hash is None or deployed_hash.decode() != deploy_hash:
+        return False
+
+    container_name = f"bot-container-{bot_id}"
+    if mode == "shared":
+        host = redis_client.get(_host_key(bot_id))
+        if host is None:
+            return False
+        container_name = host.decode()
+
+    try:
+        return client.containers.get(container_name).status == "running"
+    except docker.errors.NotFound:
+        return False
+
+
+def _deploy_image(
+    client: docker.DockerClient,
+    deployment: Deployment,
+    code: str,
+) -> docker.models.containers.Container:
+    """Runs the bot from its own image, images are tagged and reused by deploy hash."""
+    bot_id = deployment.bot_id
+    image = f"bot-{bot_id}:{deployment.code_hash[:12]}"
+    try:
+        image_id = client.images.get(image).id
+    except docker.errors.ImageNotFound:
+        # Build the Docker image, a single layer on top of the runtime image
+        runtime_image = _ensure_runtime_image(client)
+        with timed_stage("build"), build_slot(client.api.base_url):
+            built_image, _ = client.images.build(
+                fileobj=_build_context(code),
+                custom_context=True,
+                tag=image,
+                buildargs={"RUNTIME_IMAGE": runtime_image},
+                rm=True,
             )
+        image_id = built_image.id
 
-        # Run new container
-        client.containers.run(
-            f"bot-{bot_id}",
-            detach=True,
-            name=container_name,
-            privileged=True,
-            cpu_count=1,
-            cpu_shares=100,
-            mem_limit="100m",
-        )
+    deployment.advance(
+        Deployment.Status.SWAPPING,
+        image_id=image_id,
+        built_at=timezone.now(),
+    )
+    with timed_stage("swap"):
+        return _swap_container(client, bot_id, image)
+
+
+def _wait_until_ready(container: docker.models.containers.Container) -> None:
+    """Waits for the bot in the container to mark itself ready after starting."""
+    deadline = time.monotonic() + settings.BOT_READY_TIMEOUT
+    while time.monotonic() < deadline:
+        container.reload()
+        if container.status in ("exited", "dead"):
+            raise RuntimeError(
+                f"Container '{container.name}' exited before it was ready: "
+                f"{container.logs(tail=20).decode('utf-8', errors='replace')}",
+            )
+        if (
+            container.status == "running"
+            and container.exec_run(["test", "-f", READY_FILE]).exit_code == 0
+        ):
+            return
+        time.sleep(0.5)
+    raise RuntimeError(
+        f"Container '{container.name}' was not ready after {settings.BOT_READY_TIMEOUT}s",
+    )
+
+
+def _swap_container(
+    client: docker.DockerClient,
+    bot_id: int,
+    image: str,
+) -> docker.models.containers.Container:
+    """
+    Starts the new container next to the running one and retires the old container
+    only once the new one is ready, if it never gets ready the old one keeps running.
+    """
+    container_name = f"bot-container-{bot_id}"
+    staging_name = f"{container_name}-next"
+
+    try:
+        old_container = client.containers.get(container_name)
+    except docker.errors.NotFound:
+        old_container = None
+    try:
+        client.containers.get(staging_name).remove(force=True)
+    except docker.errors.NotFound:
+        pass
+
+    new_container = client.containers.run(
+        image,
+        detach=True,
+        name=staging_name,
+        network=settings.BOT_NETWORK,
+        **CONTAINER_OPTIONS,
+    )
+    try:
+        _wait_until_ready(new_container)
+    except Exception:
+        logger.error(f"Rolling back the deployment of bot {bot_id}")
+        new_container.remove(force=True)
+        raise
+
+    if old_container is not None:
+        old_container.stop()
+        old_container.remove()
+    new_container.rename(container_name)
+    return new_container
+
+
+def _deploy_mode(bot_id: int) -> str:
+    """
+    The deploy mode of the bot. Shared hosts run the bots of every user in one
+    interpreter, where code components could read the tokens of the other bots, so
+    bots with code components get their own image instead.
+    """
+    mode = settings.BOT_DEPLOY_MODE
+    if mode == "shared" and CodeComponent.objects.filter(bot_id=bot_id).exists():
+        return "image"
+    return mode
 
+
+def _deploy(deployment: Deployment) -> dict:
+    bot_id = deployment.bot_id
+    mode = _deploy_mode(bot_id)
+    deployment.advance(
+        Deployment.Status.GENERATING,
+        mode=mode,
+        started_at=timezone.now(),
+    )
+    runtime = settings.BOT_RUNTIME
+    if mode == "shared" and runtime not in ("webhook", "stream"):
+        # hosted bots are imported as modules and polled by the host
+        runtime = "polling"
+    with timed_stage("generate"):
+        _, code = get_or_build_code_artifact(deployment.bot, runtime)
+    # shared hosts run on the default docker host, other bots on the host of the bot
+    if mode == "shared":
+        client = get_client()
+    else:
+        client = get_bot_client(bot_id)
+    _ensure_network(client)
+
+    deploy_hash = _deploy_hash(code, mode)
+    deployment.advance(
+        (
+            Deployment.Status.SWAPPING
+            if mode in ("shared", "reload")
+            else Deployment.Status.BUILDING
+        ),
+        code_hash=deploy_hash,
+        generated_at=timezone.now(),
+    )
+    if _is_deployed(client, bot_id, deploy_hash, mode):
+        deployment.advance(Deployment.Status.UNCHANGED, finished_at=timezone.now())
         return {
             "status": "success",
-            "message": f"Bot {bot_id} has been successfully deployed.",
+            "message": f"Bot {bot_id} is already deployed with this code.",
         }
+
+    if mode == "shared":
+        with timed_stage("swap"):
+            container = _deploy_to_shared_host(client, bot_id, code)
+    elif mode == "reload":
+        with timed_stage("swap"):
+            container = _reload_bot(client, bot_id, code)
+    else:
+        container = _deploy_image(client, deployment, code)
+
+    # the old host, route and gateway keep serving the bot until the new one runs
+    if mode != "shared":
+        _release_shared_host(bot_id)
+    if runtime == "webhook":
+        _route_webhook(
+            client,
+            deployment.bot,
+            (_assign_host(bot_id) if mode == "shared" else f"bot-container-{bot_id}"),
+        )
+    else:
+        # the bot polls or reads its stream, it deletes its webhook on startup
+        _release_webhook(bot_id)
+    if runtime == "stream":
+        _poll_with_gateway(client, deployment.bot)
+    else:
+        # the bot polls or gets its updates posted, the gateway would compete with it
+        _release_gateway(bot_id)
+
+    redis_client.set(_deployed_key(bot_id), deploy_hash)
+    deployment.advance(
+        Deployment.Status.SUCCEEDED,
+        container_id=container.id,
+        finished_at=timezone.now(),
+    )
+    return {
+        "status": "success",
+        "message": f"Bot {bot_id} has been successfully deployed.",
+    }
+
+
+def _start_deploy(bot_id: int) -> None:
+    """
+    From now on the deploy may use an older version of the bot, so later requests are
+    queued again instead of being coalesced into it.
+    """
+    redis_client.delete(_deploy_pending_key(bot_id))
+    dequeue_deploy(bot_id)
+
+
+@shared_task(bind=True)
+def deploy_bot(self: Task, bot_id: int) -> dict:
+    deployment, _ = Deployment.objects.get_or_create(
+        task_id=self.request.id or str(uuid.uuid4()),
+        defaults={"bot_id": bot_id},
+    )
+    started = False
+    try:
+        # deploys of the same bot run one after the other, requests arriving while
+        # this one waits for the lock are coalesced into it
+        with redis_client.lock(
+            f"deploy::lock::{bot_id}",
+            timeout=settings.DEPLOY_LOCK_TIMEOUT,
+        ):
+            _start_deploy(bot_id)
+            started = True
+            return _deploy(deployment)
     except Exception as e:
+        if not started:
+            _start_deploy(bot_id)
         logger.error(f"Deployment error for bot {bot_id}: {e}")
+        deployment.advance(
+            Deployment.Status.FAILED,
+            error=str(e),
+            finished_at=timezone.now(),
+        )
         return {"status": "error", "message": str(e)}
@@ -0,0 +1,108 @@
+"""
+Code generation benchmarks on synthetic bot graphs, run them with
+
+    python manage.py test bot.test.benchmarks
+
+Results are written as JSON to CODEGEN_BENCHMARK_OUTPUT (default
+codegen_benchmarks.json), sizes are set with CODEGEN_BENCHMARK_SIZES.
+"""
+
+import json
+import os
+import statistics
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from bot.models import Bot
+from bot.services import generate_code
+from bot.test.factory import (
+    BotFactory,
+    build_chain,
+    build_fanout,
+    build_markup_menu,
+    build_switch_tree,
+)
+from component.cache import invalidate_snippets
+from component.models import Component, Markup
+
+SIZES = [
+    int(size)
+    for size in os.environ.get("CODEGEN_BENCHMARK_SIZES", "10,100,500").split(",")
+]
+REPEAT = int(os.environ.get("CODEGEN_BENCHMARK_REPEAT", 5))
+OUTPUT = os.environ.get("CODEGEN_BENCHMARK_OUTPUT", "codegen_benchmarks.json")
+
+SHAPES: Dict[str, Callable[[Bot, int], None]] = {
+    "chain": build_chain,
+    "fanout": build_fanout,
+    "switch_tree": build_switch_tree,
+    "markup_menu": build_markup_menu,
+}
+
+
+def measure(bot: Bot, cold: bool) -> dict:
+    """Wall time, query count and peak memory of generating the code of the bot."""
+    pks = list(Component.objects.filter(bot=bot).values_list("id", flat=True))
+
+    timings = []
+    for _ in range(REPEAT):
+        if cold:
+            invalidate_snippets(pks)
+        start = time.perf_counter()
+        generate_code(bot)
+        timings.append(time.perf_counter() - start)
+
+    if cold:
+        invalidate_snippets(pks)
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        code = generate_code(bot)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "wall_time_min": min(timings),
+        "wall_time_median": statistics.median(timings),
+        "queries": len(queries),
+        "peak_memory": peak_memory,
+        "code_size": len(code),
+    }
+
+
+class CodeGenerationBenchmark(TestCase):
+    results: List[dict] = []
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        super().tearDownClass()
+        with open(OUTPUT, "w") as f:
+            json.dump({"repeat": REPEAT, "results": cls.results}, f, indent=2)
+
+    def test_generate_code(self):
+        for shape, build in SHAPES.items():
+            for size in SIZES:
+                with self.subTest(shape=shape, size=size):
+                    bot = BotFactory()
+                    build(bot, size)
+                    result = {
+                        "shape": shape,
+                        "size": size,
+                        "components": Component.objects.filter(bot=bot).count(),
+                        "markups": Markup.objects.filter(
+                            parent_component__bot=bot,
+                        ).count(),
+                        "cold": measure(bot, cold=True),
+                        "warm": measure(bot, cold=False),
+                    }
+                    self.results.append(result)
+                    print(
+                        f"{shape:<12} {result['components']:>5} components "
+                        f"cold {result['cold']['wall_time_median'] * 1000:8.1f}ms "
+                        f"warm {result['warm']['wall_time_median'] * 1000:8.1f}ms "
+                        f"{result['cold']['queries']} queries",
+                    )
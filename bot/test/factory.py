@@ -0,0 +1,116 @@
+import factory
+from faker import Faker
+
+from bot.models import Bot
+from component.models import Component, Markup, OnMessage, SwitchComponent
+from component.telegram.models import SendMessage
+from iam.test.factory import IamUserFactory
+
+fake = Faker()
+
+
+class BotFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = Bot
+
+    name = factory.LazyAttribute(lambda x: fake.user_name())
+    description = factory.LazyAttribute(lambda x: fake.sentence())
+    token = factory.Sequence(lambda n: f"{n}:{fake.sha1()}")
+    user = factory.SubFactory(IamUserFactory)
+
+
+class OnMessageFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = OnMessage
+
+    bot = factory.SubFactory(BotFactory)
+    component_type = Component.ComponentType.TRIGGER
+    text = factory.Sequence(lambda n: f"/command{n}")
+    position_x = 1
+    position_y = 1
+
+
+class SendMessageFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = SendMessage
+
+    bot = factory.SubFactory(BotFactory)
+    chat_id = ".from_user.id"
+    text = factory.LazyAttribute(lambda x: f"{fake.sentence()} $.text")
+    position_x = 1
+    position_y = 1
+
+
+class SwitchComponentFactory(factory.django.DjangoModelFactory):
+    class Meta:
+        model = SwitchComponent
+
+    bot = factory.SubFactory(BotFactory)
+    expression = ".text"
+    position_x = 1
+    position_y = 1
+
+
+def build_chain(bot: Bot, size: int) -> None:
+    """A trigger followed by a linear chain of messages."""
+    previous = OnMessageFactory(bot=bot)
+    for _ in range(size - 1):
+        previous = SendMessageFactory(bot=bot, previous_component=previous)
+
+
+def build_fanout(bot: Bot, size: int) -> None:
+    """A trigger with every other message as its direct next component."""
+    trigger = OnMessageFactory(bot=bot)
+    for _ in range(size - 1):
+        SendMessageFactory(bot=bot, previous_component=trigger)
+
+
+def build_switch_tree(bot: Bot, size: int) -> None:
+    """A trigger followed by a complete binary tree of switches with message leaves."""
+
+    def build(depth: int) -> Component:
+        if depth == 0:
+            return SendMessageFactory(bot=bot)
+        branches = [build(depth - 1), build(depth - 1)]
+        return SwitchComponentFactory(
+            bot=bot,
+            values=[f"{depth}a", f"{depth}b"],
+            next_components=[branch.id for branch in branches],
+        )
+
+    trigger = OnMessageFactory(bot=bot)
+    root = build(max(size.bit_length() - 2, 1))
+    root.previous_component = trigger
+    root.save()
+
+
+def build_markup_menu(bot: Bot, size: int) -> None:
+    """
+    A trigger answering with a reply keyboard menu, each menu item answers with an
+    inline keyboard leading to a shared message.
+    """
+    trigger = OnMessageFactory(bot=bot)
+    menu = SendMessageFactory(bot=bot, previous_component=trigger)
+    done = SendMessageFactory(bot=bot)
+
+    items = []
+    for index in range((size - 3) // 2):
+        item = SendMessageFactory(bot=bot)
+        Markup.objects.create(
+            parent_component=item,
+            markup_type=Markup.MarkupType.InlineKeyboard,
+            buttons=[[{"value": f"Done {index}", "next_component": done.id}]],
+        )
+        items.append(item)
+
+    Markup.objects.create(
+        parent_component=menu,
+        markup_type=Markup.MarkupType.ReplyKeyboard,
+        buttons=[
+            [
+                {"value": f"Item {index}", "next_component": item.id}
+                for index, item in enumerate(items[row : row + 3], start=row)
+            ]
+            for row in range(0, len(items), 3)
+        ],
+    )
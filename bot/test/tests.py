@@ -1,9 +1,60 @@
-from django.test import TestCase
+import ast
+import asyncio
+import io
+import json
+import multiprocessing
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+import docker
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
 from django.urls import reverse
 from PIL import Image
+from redis import Redis
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 
-from bot.models import Bot
+from bot import docker_client
+from bot.logs import iter_log_events, read_logs
+from bot.models import Bot, Deployment
+from bot.runtime import RUNTIMES, STORAGES, RuntimeTemplate
+from bot.scheduler import DEPLOY_QUEUE_KEY, build_slot, get_metrics
+from bot.services import (
+    _artifact_error_key,
+    _artifact_key,
+    _template_hash,
+    build_code_artifact,
+    code_fingerprint,
+    generate_code,
+    iter_code,
+)
+from bot.tasks import (
+    GATEWAY_TOKENS_DIR,
+    INGRESS_ROUTES_DIR,
+    _assign_host,
+    _deploy_image,
+    _deployed_key,
+    _ensure_runtime_image,
+    _gateway_key,
+    _release_shared_host,
+    _reload_bot,
+    _route_key,
+    _swap_container,
+    deploy_bot,
+    generate_bot_code,
+    release_gateway,
+    release_webhook,
+)
+from bot.updates import (
+    UPDATES_GROUP,
+    get_update_metrics,
+    updates_offset_key,
+    updates_stream_key,
+)
+from component.cache import invalidate_snippets, set_snippets
 from component.models import (
     CodeComponent,
     Component,
@@ -16,13 +67,23 @@ from component.models import (
 from component.telegram.models import SendMessage
 from iam.models import IamUser
 from iam.utils import create_token_for_iamuser
+from utils.redis import redis_client
 
 # Create your tests here.
 
 
+def delete_code_artifacts() -> None:
+    # bot ids start over with every test database, artifacts of a previous run
+    # would be served for the bots of this one
+    for pattern in ("codegen::bot::*", "codegen::error::*"):
+        for key in redis_client.scan_iter(pattern):
+            redis_client.delete(key)
+
+
 class CodeTest(TestCase):
 
     def setUp(self):
+        self.addCleanup(delete_code_artifacts)
         # a simple bot with a code component
         self.user = IamUser.objects.create()
 
@@ -230,3 +291,1023 @@ welcome to the bot $.text with chat id $.chat.id""",
         # print(response.content.decode())
         with open("code_1.py", "w") as f:
             f.write(response.content.decode())
+
+    def test_generate_code_uses_bulk_queries(self):
+        # warm up the content type cache
+        code = generate_code(self.bot)
+
+        # one query for the base rows, one per concrete class (6) and one for markups
+        with self.assertNumQueries(8):
+            self.assertEqual(generate_code(self.bot), code)
+
+    def test_generate_code_reuses_cached_snippets(self):
+        token = create_token_for_iamuser(self.user.id)
+        generate_code(self.bot)
+        send_message = SendMessage.objects.get(bot=self.bot, text="OK, thanks")
+
+        with mock.patch.object(
+            SendMessage,
+            "generate_code",
+            autospec=True,
+            side_effect=SendMessage.generate_code,
+        ) as generate_code_mock:
+            generate_code(self.bot)
+            generate_code_mock.assert_not_called()
+
+            response = self.client.patch(
+                reverse(
+                    "component:sendmessage-detail",
+                    args=[self.bot.id, send_message.id],
+                ),
+                data={"text": "OK, thank you"},
+                content_type="application/json",
+                headers={"Authorization": token},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+
+            code = generate_code(self.bot)
+            self.assertEqual(generate_code_mock.call_count, 1)
+            self.assertEqual(generate_code_mock.call_args.args[0].pk, send_message.pk)
+            self.assertIn("OK, thank you", code)
+
+    def test_generated_snippets_are_cached_per_partition(self):
+        components = Component.objects.filter(bot=self.bot)
+        invalidate_snippets(components.values_list("pk", flat=True))
+
+        with mock.patch("bot.services.set_snippets", wraps=set_snippets) as set_mock:
+            chunks = iter_code(self.bot)
+            # the header and the first component
+            next(chunks)
+            next(chunks)
+            self.assertEqual(set_mock.call_count, 1)
+            list(chunks)
+
+        triggers = components.filter(component_type=Component.ComponentType.TRIGGER)
+        self.assertEqual(set_mock.call_count, triggers.count())
+        cached = [pk for call in set_mock.call_args_list for pk in call.args[0]]
+        self.assertCountEqual(cached, components.values_list("pk", flat=True))
+
+    def test_shared_subgraph_is_generated_once(self):
+        send_message_help = SendMessage.objects.get(
+            bot=self.bot,
+            text="This is test help message",
+        )
+        help_trigger = OnMessage.objects.create(
+            bot=self.bot,
+            text="/help",
+            position_x=1,
+            position_y=1,
+        )
+        SwitchComponent.objects.create(
+            bot=self.bot,
+            position_x=1,
+            position_y=1,
+            previous_component=help_trigger,
+            expression=".text",
+            values=["/help"],
+            next_components=[send_message_help.id],
+        )
+
+        code = generate_code(self.bot)
+        self.assertEqual(
+            code.count(f"async def {send_message_help.code_function_name}("),
+            1,
+        )
+
+    def test_generate_code_in_parallel(self):
+        for index in range(4):
+            trigger = OnMessage.objects.create(
+                bot=self.bot,
+                text=f"/command{index}",
+                position_x=1,
+                position_y=1,
+            )
+            SendMessage.objects.create(
+                bot=self.bot,
+                chat_id=".from_user.id",
+                text=f"command {index}",
+                position_x=1,
+                position_y=1,
+                previous_component=trigger,
+            )
+        pks = Component.objects.filter(bot=self.bot).values_list("id", flat=True)
+
+        invalidate_snippets(pks)
+        code = generate_code(self.bot)
+        invalidate_snippets(pks)
+        with (
+            self.settings(CODEGEN_WORKERS=2, CODEGEN_PARALLEL_MIN_TRIGGERS=2),
+            mock.patch(
+                "bot.services.ProcessPoolExecutor",
+                side_effect=ProcessPoolExecutor,
+            ) as executor_mock,
+        ):
+            self.assertEqual(generate_code(self.bot), code)
+            executor_mock.assert_called_once()
+
+    def test_generate_code_task_in_a_daemonic_worker(self):
+        for index in range(2):
+            OnMessage.objects.create(
+                bot=self.bot,
+                text=f"/command{index}",
+                position_x=1,
+                position_y=1,
+            )
+        invalidate_snippets(
+            Component.objects.filter(bot=self.bot).values_list("id", flat=True),
+        )
+
+        # celery prefork workers are daemonic processes, like this one is made
+        with (
+            self.settings(CODEGEN_WORKERS=2, CODEGEN_PARALLEL_MIN_TRIGGERS=2),
+            mock.patch.dict(multiprocessing.current_process()._config, daemon=True),
+        ):
+            result = generate_bot_code.delay(self.bot.id, settings.BOT_RUNTIME).get()
+        self.assertEqual(result["status"], "success", result)
+
+    def test_generate_code_stream(self):
+        token = create_token_for_iamuser(self.user.id)
+        url = reverse("bot:generate-code", args=[self.bot.id])
+        response = self.client.get(
+            url,
+            {"stream": "true"},
+            headers={
+                "Authorization": token,
+            },
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            b"".join(response.streaming_content).decode(),
+            generate_code(self.bot, storage=settings.BOT_DOWNLOAD_STORAGE),
+        )
+
+    def test_generate_code_stream_errors(self):
+        token = create_token_for_iamuser(self.user.id)
+        url = reverse("bot:generate-code", args=[self.bot.id])
+        invalidate_snippets(
+            Component.objects.filter(bot=self.bot).values_list("pk", flat=True),
+        )
+
+        # the response has started when a component fails, the file raises the error
+        with mock.patch.object(
+            SendMessage,
+            "generate_code",
+            side_effect=ValidationError("Text is missing"),
+        ):
+            response = self.client.get(
+                url,
+                {"stream": "true"},
+                headers={"Authorization": token},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            code = b"".join(response.streaming_content).decode()
+        self.assertTrue(
+            code.endswith(
+                "\n\nraise RuntimeError('Code generation failed: Text is missing')\n",
+            ),
+        )
+        compile(code, "bot.py", "exec")
+
+        markup = Markup.objects.get(
+            parent_component__bot=self.bot,
+            markup_type=Markup.MarkupType.InlineKeyboard,
+        )
+        Component.objects.filter(id=markup.buttons[0][0]["next_component"]).delete()
+        response = self.client.get(
+            url,
+            {"stream": "true"},
+            headers={"Authorization": token},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("does not exist", response.content.decode())
+
+    def test_generate_code_artifact(self):
+        token = create_token_for_iamuser(self.user.id)
+        url = reverse("bot:generate-code", args=[self.bot.id])
+        response = self.client.get(url, headers={"Authorization": token})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        etag = response["ETag"]
+
+        with mock.patch("bot.views.enqueue_generate_bot_code") as enqueue_mock:
+            cached_response = self.client.get(url, headers={"Authorization": token})
+            enqueue_mock.assert_not_called()
+        self.assertEqual(cached_response.content, response.content)
+
+        response = self.client.get(
+            url,
+            headers={"Authorization": token, "If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # nginx weakens the tags of gzipped responses
+        response = self.client.get(
+            url,
+            headers={"Authorization": token, "If-None-Match": f"W/{etag}"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        send_message = SendMessage.objects.get(bot=self.bot, text="OK, thanks")
+        response = self.client.patch(
+            reverse(
+                "component:sendmessage-detail",
+                args=[self.bot.id, send_message.id],
+            ),
+            data={"text": "OK, thank you"},
+            content_type="application/json",
+            headers={"Authorization": token},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+
+        response = self.client.get(
+            url,
+            headers={"Authorization": token, "If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn("OK, thank you", response.content.decode())
+
+    def test_code_fingerprint_follows_templates_and_settings(self):
+        fingerprint = code_fingerprint(self.bot)
+        self.assertEqual(code_fingerprint(self.bot), fingerprint)
+        with self.settings(BALE_API_URL="https://bale.example"):
+            self.assertNotEqual(code_fingerprint(self.bot), fingerprint)
+        with mock.patch(
+            "bot.services.get_runtime_template",
+            return_value=RuntimeTemplate("{FUNCTION_CODES}"),
+        ):
+            _template_hash.cache_clear()
+            self.addCleanup(_template_hash.cache_clear)
+            self.assertNotEqual(code_fingerprint(self.bot), fingerprint)
+
+    def test_schema_etag(self):
+        token = create_token_for_iamuser(self.user.id)
+        url = reverse("component:schema", args=[self.bot.id])
+        response = self.client.get(url, headers={"Authorization": token})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        etag = response["ETag"]
+
+        response = self.client.get(
+            url,
+            headers={"Authorization": token, "If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # nginx weakens the tags of gzipped responses
+        response = self.client.get(
+            url,
+            headers={"Authorization": token, "If-None-Match": f'"0", W/{etag}'},
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+        response = self.client.delete(
+            reverse(
+                "component:markup-detail",
+                args=[
+                    self.bot.id,
+                    Markup.objects.filter(parent_component__bot=self.bot).first().id,
+                ],
+            ),
+            headers={"Authorization": token},
+        )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get(
+            url,
+            headers={"Authorization": token, "If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_generate_code_pending(self):
+        token = create_token_for_iamuser(self.user.id)
+        url = reverse("bot:generate-code", args=[self.bot.id])
+        with (
+            mock.patch("bot.views.get_code_artifact", return_value=None),
+            mock.patch(
+                "bot.views.enqueue_generate_bot_code",
+                return_value="task-id",
+            ) as enqueue_mock,
+        ):
+            response = self.client.get(url, headers={"Authorization": token})
+
+        enqueue_mock.assert_called_once_with(
+            self.bot.id,
+            settings.BOT_RUNTIME,
+            settings.BOT_DOWNLOAD_STORAGE,
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data, {"status": "pending", "task_id": "task-id"})
+
+    def test_generate_code_error_ends_polling(self):
+        markup = Markup.objects.get(
+            parent_component__bot=self.bot,
+            markup_type=Markup.MarkupType.InlineKeyboard,
+        )
+        # buttons keep pointing at components after they are deleted
+        Component.objects.filter(id=markup.buttons[0][0]["next_component"]).delete()
+        fingerprint = code_fingerprint(self.bot)
+        keys = [
+            _artifact_key(self.bot.id, fingerprint),
+            _artifact_error_key(self.bot.id, fingerprint),
+        ]
+        redis_client.delete(*keys)
+        self.addCleanup(redis_client.delete, *keys)
+
+        token = create_token_for_iamuser(self.user.id)
+        url = reverse("bot:generate-code", args=[self.bot.id])
+        response = self.client.get(url, headers={"Authorization": token})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("does not exist", response.content.decode())
+
+        with mock.patch("bot.views.enqueue_generate_bot_code") as enqueue_mock:
+            response = self.client.get(url, headers={"Authorization": token})
+            enqueue_mock.assert_not_called()
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_webhook_bots_are_routed_through_the_ingress(self):
+        self.addCleanup(redis_client.delete, _deployed_key(self.bot.id))
+        self.addCleanup(redis_client.delete, _route_key(self.bot.id))
+        client = mock.Mock()
+        client.api.base_url = "tcp://docker-host"
+        ingress = client.containers.get.return_value
+        ingress.status = "running"
+        ingress.attrs = {"Config": {"Image": "runtime:1"}}
+
+        with (
+            mock.patch("bot.tasks.get_bot_client", return_value=client),
+            mock.patch("bot.tasks._ensure_runtime_image", return_value="runtime:1"),
+            mock.patch("bot.tasks._deploy_image") as deploy_image_mock,
+            self.settings(BOT_DEPLOY_MODE="image", BOT_RUNTIME="webhook"),
+        ):
+            deploy_image_mock.return_value.id = "container-id"
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "success")
+
+        self.assertIn("set_webhook", deploy_image_mock.call_args.args[2])
+        path, archive = ingress.put_archive.call_args.args
+        self.assertEqual(path, INGRESS_ROUTES_DIR)
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            self.assertEqual(
+                tar.extractfile(self.bot.webhook_path.lstrip("/")).read(),
+                f"http://bot-container-{self.bot.id}:8080".encode(),
+            )
+        ingress.kill.assert_called_once_with(signal="SIGHUP")
+
+        # bots deployed on another runtime delete their webhook and lose their route
+        with (
+            mock.patch("bot.tasks.get_bot_client", return_value=client),
+            mock.patch("bot.tasks.get_client", return_value=client) as get_client_mock,
+            mock.patch("bot.tasks._ensure_runtime_image", return_value="runtime:1"),
+            mock.patch("bot.tasks._deploy_image") as deploy_image_mock,
+            self.settings(BOT_DEPLOY_MODE="image", BOT_RUNTIME="polling"),
+        ):
+            deploy_image_mock.return_value.id = "container-id"
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "success")
+        self.assertIn("delete_webhook", deploy_image_mock.call_args.args[2])
+        get_client_mock.assert_called_once_with("tcp://docker-host")
+        ingress.exec_run.assert_called_once_with(
+            ["rm", "-f", f"{INGRESS_ROUTES_DIR}/{self.bot.webhook_path.lstrip('/')}"],
+        )
+        self.assertEqual(ingress.kill.call_count, 2)
+        self.assertFalse(redis_client.exists(_route_key(self.bot.id)))
+
+    def test_redeploying_identical_code_is_a_no_op(self):
+        self.addCleanup(redis_client.delete, _deployed_key(self.bot.id))
+        client = mock.Mock()
+        client.containers.get.return_value.status = "running"
+
+        with (
+            mock.patch("bot.tasks.get_bot_client", return_value=client),
+            mock.patch("bot.tasks._release_shared_host"),
+            mock.patch("bot.tasks._deploy_image") as deploy_image_mock,
+            self.settings(BOT_DEPLOY_MODE="image"),
+        ):
+            deploy_image_mock.return_value.id = "container-id"
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "success")
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "success")
+            deploy_image_mock.assert_called_once()
+            self.assertEqual(
+                list(self.bot.deployments.values_list("status", flat=True)),
+                [Deployment.Status.UNCHANGED, Deployment.Status.SUCCEEDED],
+            )
+
+            Bot.bump_version(self.bot.id)
+            SendMessage.objects.filter(bot=self.bot, text="OK, thanks").update(
+                text="OK, thank you",
+            )
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "success")
+            self.assertEqual(deploy_image_mock.call_count, 2)
+
+    def test_bots_with_code_components_are_not_deployed_to_shared_hosts(self):
+        self.addCleanup(redis_client.delete, _deployed_key(self.bot.id))
+        client = mock.Mock()
+        client.containers.get.return_value.status = "running"
+
+        with (
+            mock.patch("bot.tasks.get_bot_client", return_value=client),
+            mock.patch("bot.tasks._release_shared_host"),
+            mock.patch("bot.tasks._deploy_to_shared_host") as shared_mock,
+            mock.patch("bot.tasks._deploy_image") as deploy_image_mock,
+            self.settings(BOT_DEPLOY_MODE="shared", BOT_RUNTIME="polling"),
+        ):
+            deploy_image_mock.return_value.id = "container-id"
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "success")
+
+        shared_mock.assert_not_called()
+        deploy_image_mock.assert_called_once()
+        self.assertEqual(self.bot.deployments.get().mode, "image")
+
+    def test_failed_deploys_keep_the_old_host_and_gateway(self):
+        client = mock.Mock()
+
+        with (
+            mock.patch("bot.tasks.get_bot_client", return_value=client),
+            mock.patch("bot.tasks._release_shared_host") as release_host_mock,
+            mock.patch("bot.tasks._release_gateway") as release_gateway_mock,
+            mock.patch("bot.tasks._route_webhook") as route_mock,
+            mock.patch("bot.tasks._deploy_image", side_effect=RuntimeError("down")),
+            self.settings(BOT_DEPLOY_MODE="image", BOT_RUNTIME="webhook"),
+        ):
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "error")
+
+        release_host_mock.assert_not_called()
+        release_gateway_mock.assert_not_called()
+        route_mock.assert_not_called()
+
+    def test_pending_deploys_are_coalesced(self):
+        token = create_token_for_iamuser(self.user.id)
+        self.addCleanup(redis_client.delete, f"deploy::pending::{self.bot.id}")
+        self.addCleanup(redis_client.zrem, DEPLOY_QUEUE_KEY, self.bot.id)
+        url = reverse("bot:deploy", args=[self.bot.id])
+
+        with mock.patch.object(deploy_bot, "apply_async") as apply_async_mock:
+            response = self.client.get(url, headers={"Authorization": token})
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(response.data["deployment"]["status"], "queued")
+            response = self.client.get(url, headers={"Authorization": token})
+            apply_async_mock.assert_called_once_with(
+                args=[self.bot.id],
+                task_id=response.data["task_id"],
+            )
+        self.assertIsNotNone(redis_client.zscore(DEPLOY_QUEUE_KEY, self.bot.id))
+
+        response = self.client.get(
+            reverse("bot:deployments", args=[self.bot.id]),
+            headers={"Authorization": token},
+        )
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(
+            response.data[0]["task_id"],
+            apply_async_mock.call_args.kwargs["task_id"],
+        )
+
+    def test_deploys_are_coalesced_until_the_lock_is_taken(self):
+        pending_key = f"deploy::pending::{self.bot.id}"
+        self.addCleanup(redis_client.delete, pending_key)
+        redis_client.set(pending_key, "task-id")
+        events = []
+        lock = mock.MagicMock()
+        lock.__enter__.side_effect = lambda: events.append(
+            ("locked", redis_client.get(pending_key)),
+        )
+
+        with (
+            mock.patch.object(redis_client, "lock", return_value=lock),
+            mock.patch(
+                "bot.tasks._deploy",
+                side_effect=lambda deployment: events.append(
+                    ("deploying", redis_client.get(pending_key)),
+                ),
+            ),
+        ):
+            deploy_bot.apply(args=[self.bot.id], task_id="task-id")
+
+        self.assertEqual(events, [("locked", b"task-id"), ("deploying", None)])
+
+    def test_deploy_metrics_require_staff(self):
+        url = reverse("deploy-metrics")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        token = create_token_for_iamuser(self.user.id)
+        response = self.client.get(url, headers={"Authorization": token})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_login(User.objects.create(username="admin", is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("running_builds", response.data)
+
+    def test_update_metrics_are_those_of_the_bots_of_the_user(self):
+        url = reverse("bot:update-metrics")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        bot_redis = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=1)
+        other_bot = Bot.objects.create(
+            name="Other Bot",
+            token="1367633213:another-token",
+            user=IamUser.objects.create(email="other@example.com"),
+        )
+        for bot in (self.bot, other_bot):
+            stream = updates_stream_key(bot.id)
+            self.addCleanup(bot_redis.delete, stream)
+            bot_redis.xgroup_create(stream, UPDATES_GROUP, id="0", mkstream=True)
+
+        token = create_token_for_iamuser(self.user.id)
+        with mock.patch("bot.updates.bot_redis_client", bot_redis):
+            response = self.client.get(url, headers={"Authorization": token})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data), [str(self.bot.id)])
+
+    def test_generate_code_for_every_runtime(self):
+        for runtime in RUNTIMES:
+            with self.subTest(runtime=runtime):
+                code = generate_code(self.bot, runtime)
+                ast.parse(code)
+        self.assertIn(self.bot.webhook_path, generate_code(self.bot, "webhook"))
+        self.assertIn(
+            updates_stream_key(self.bot.id),
+            generate_code(self.bot, "stream"),
+        )
+
+    def test_user_data_is_stored_and_read_once_per_component(self):
+        for storage in STORAGES:
+            with self.subTest(storage=storage), self.settings(BOT_STORAGE=storage):
+                code = generate_code(self.bot)
+                ast.parse(code)
+                self.assertNotIn("data_dict", code)
+
+        self.assertIn("await data_store.set(message.from_user.id, 'phone_number'", code)
+        self.assertEqual(code.count("await data_store.get("), 1)
+        self.assertIn('user_data.get("phone_number")', code)
+
+    def test_downloads_use_memory_storage(self):
+        token = create_token_for_iamuser(self.user.id)
+        url = reverse("bot:generate-code", args=[self.bot.id])
+
+        response = self.client.get(url, headers={"Authorization": token})
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.assertIn("MemoryStorage()", response.content.decode())
+        self.assertNotIn(settings.BOT_REDIS_URL, response.content.decode())
+
+        response = self.client.get(
+            url,
+            {"storage": "redis"},
+            headers={"Authorization": token},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+        self.assertIn(settings.BOT_REDIS_URL, response.content.decode())
+
+        response = self.client.get(
+            url,
+            {"storage": "disk"},
+            headers={"Authorization": token},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_code_components_use_data_dict(self):
+        code_component = CodeComponent.objects.create(
+            bot=self.bot,
+            code=(
+                "kwargs['seen'].append(data_dict[message.from_user.id]['phone_number'])\n"
+                "data_dict[message.from_user.id]['name'] = 'Ali'\n"
+                "return"
+            ),
+            position_x=1,
+            position_y=1,
+            previous_component=OnMessage.objects.get(bot=self.bot, text="/start"),
+        )
+
+        namespace = {}
+        exec(generate_code(self.bot, storage="memory"), namespace)
+        message = mock.Mock()
+        message.from_user.id = 1
+        seen = []
+        asyncio.run(namespace["data_store"].set(1, "phone_number", "123"))
+        asyncio.run(
+            namespace[code_component.code_function_name](message, seen=seen),
+        )
+        self.assertEqual(seen, ["123"])
+        self.assertEqual(
+            asyncio.run(namespace["data_store"].get(1)),
+            {"phone_number": "123", "name": "Ali"},
+        )
+
+    def test_text_parameters_are_escaped(self):
+        send_message = SendMessage.objects.get(bot=self.bot, text="OK, thanks")
+        send_message.text = (
+            "first {brace} and ''' quotes \\ for $.text and $[phone_number]"
+        )
+        send_message.save()
+
+        code = generate_code(self.bot)
+        [text] = [
+            node.value
+            for node in ast.walk(ast.parse(code))
+            if isinstance(node, ast.keyword)
+            and node.arg == "text"
+            and "brace" in ast.unparse(node.value)
+        ]
+        self.assertEqual(
+            eval(
+                compile(ast.Expression(text), "bot.py", "eval"),
+                {
+                    "input_data": mock.Mock(text="hi"),
+                    "user_data": {"phone_number": "123"},
+                },
+            ),
+            "first {brace} and ''' quotes \\ for hi and 123",
+        )
+
+        send_message.text = 'f"unterminated" literal"'
+        send_message.save()
+        with self.assertRaisesMessage(ValidationError, "Generated code is invalid"):
+            build_code_artifact(self.bot)
+
+    def test_text_triggers_are_routed_through_a_dispatch_table(self):
+        triggers = [
+            OnMessage.objects.create(
+                bot=self.bot,
+                position_x=1,
+                position_y=1,
+                component_type=Component.ComponentType.TRIGGER,
+                **options,
+            )
+            for options in [
+                dict(text="Hi", case_sensitive=True),
+                dict(text="hello"),
+                dict(text=r"b+", regex=True),
+                dict(text=r"(a)\1", regex=True),
+                dict(text=r"a", regex=True),
+            ]
+        ]
+        for trigger in triggers:
+            SendMessage.objects.create(
+                bot=self.bot,
+                chat_id=".from_user.id",
+                text="routed",
+                position_x=1,
+                position_y=1,
+                previous_component=trigger,
+            )
+
+        with self.settings(BOT_STORAGE="memory"):
+            code = generate_code(self.bot)
+        self.assertNotIn("@dp.message(F.text ==", code)
+        namespace = {}
+        exec(code, namespace)
+        route = namespace["text_router"].match
+        handlers = [namespace[trigger.code_function_name] for trigger in triggers]
+
+        self.assertIs(route("Hi"), handlers[0])
+        self.assertIsNone(route("hi"))
+        self.assertIs(route("HeLLo"), handlers[1])
+        # patterns match at the start of the text, the first one registered wins
+        self.assertIs(route("bba"), handlers[2])
+        self.assertIs(route("aab"), handlers[3])
+        self.assertIs(route("ab"), handlers[4])
+        self.assertIsNone(route("xa"))
+        self.assertIsNone(route("xyz"))
+
+    def test_inline_buttons_are_routed_by_compact_callback_data(self):
+        markup = Markup.objects.get(
+            parent_component__bot=self.bot,
+            markup_type=Markup.MarkupType.InlineKeyboard,
+        )
+        with self.settings(BOT_STORAGE="memory"):
+            code = generate_code(self.bot)
+        self.assertNotIn("@dp.callback_query(lambda", code)
+        namespace = {}
+        exec(code, namespace)
+        routes = namespace["callback_routes"]
+
+        for row_index, row in enumerate(markup.buttons):
+            callback_data = markup.get_callback_data(row_index, 0)
+            self.assertLessEqual(len(callback_data), 64)
+            self.assertIn(f"callback_data={callback_data!r}", code)
+            next_component = SendMessage.objects.get(id=row[0]["next_component"])
+            self.assertIs(
+                routes[callback_data],
+                namespace[f"{next_component.code_function_name}_callback"],
+            )
+        self.assertEqual(len(routes), 2)
+
+    def test_stream_bots_are_polled_by_the_gateway(self):
+        self.addCleanup(redis_client.delete, _deployed_key(self.bot.id))
+        self.addCleanup(redis_client.delete, _gateway_key(self.bot.id))
+        client = mock.Mock()
+        client.api.base_url = "tcp://docker-host"
+        gateway = client.containers.get.return_value
+        gateway.status = "running"
+        gateway.attrs = {"Config": {"Image": "runtime:1"}}
+
+        with (
+            mock.patch("bot.tasks.get_bot_client", return_value=client),
+            mock.patch("bot.tasks._ensure_runtime_image", return_value="runtime:1"),
+            mock.patch("bot.tasks._deploy_image") as deploy_image_mock,
+            self.settings(BOT_DEPLOY_MODE="image", BOT_RUNTIME="stream"),
+        ):
+            deploy_image_mock.return_value.id = "container-id"
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "success")
+
+        path, archive = gateway.put_archive.call_args.args
+        self.assertEqual(path, GATEWAY_TOKENS_DIR)
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            self.assertEqual(
+                tar.extractfile(str(self.bot.id)).read(),
+                self.bot.token.encode(),
+            )
+        gateway.kill.assert_called_once_with(signal="SIGHUP")
+
+        # bots deployed on another runtime poll by themselves
+        with (
+            mock.patch("bot.tasks.get_bot_client", return_value=client),
+            mock.patch("bot.tasks.get_client", return_value=client) as get_client_mock,
+            mock.patch("bot.tasks.bot_redis_client") as bot_redis_mock,
+            mock.patch("bot.tasks._ensure_runtime_image", return_value="runtime:1"),
+            mock.patch("bot.tasks._deploy_image") as deploy_image_mock,
+            self.settings(BOT_DEPLOY_MODE="image", BOT_RUNTIME="polling"),
+        ):
+            deploy_image_mock.return_value.id = "container-id"
+            self.assertEqual(deploy_bot(self.bot.id)["status"], "success")
+        get_client_mock.assert_called_once_with("tcp://docker-host")
+        gateway.exec_run.assert_called_once_with(
+            ["rm", "-f", f"{GATEWAY_TOKENS_DIR}/{self.bot.id}"],
+        )
+        self.assertEqual(gateway.kill.call_count, 2)
+        bot_redis_mock.delete.assert_called_once_with(updates_offset_key(self.bot.id))
+        self.assertIsNone(redis_client.get(_gateway_key(self.bot.id)))
+
+    def test_gateway_stops_polling_deleted_bots_and_old_tokens(self):
+        token = create_token_for_iamuser(self.user.id)
+        url = reverse("bot:delete-bot", args=[self.bot.id])
+
+        with (
+            mock.patch.object(release_gateway, "delay") as release_mock,
+            mock.patch.object(release_webhook, "delay") as release_webhook_mock,
+        ):
+            response = self.client.patch(
+                url,
+                data={"description": "A new description"},
+                content_type="application/json",
+                headers={"Authorization": token},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+            release_mock.assert_not_called()
+
+            response = self.client.patch(
+                url,
+                data={"token": "1367633212:another-token"},
+                content_type="application/json",
+                headers={"Authorization": token},
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK, response.content)
+            release_mock.assert_called_once_with(self.bot.id)
+            release_webhook_mock.assert_called_once_with(self.bot.id)
+
+            response = self.client.delete(url, headers={"Authorization": token})
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertEqual(release_mock.call_count, 2)
+            self.assertEqual(release_webhook_mock.call_count, 2)
+
+
+class RuntimeTemplateTest(SimpleTestCase):
+
+    def test_only_named_slots_are_replaced(self):
+        template = RuntimeTemplate("a = {TOKEN}\n{FUNCTION_CODES}\nb = {'x': f'{e}'}")
+
+        self.assertEqual(
+            template.render(TOKEN="1", FUNCTION_CODES="pass"),
+            "a = 1\npass\nb = {'x': f'{e}'}",
+        )
+        self.assertEqual(
+            template.split("FUNCTION_CODES", TOKEN="1"),
+            ("a = 1\n", "\nb = {'x': f'{e}'}"),
+        )
+
+
+def log_stream(*chunks: bytes) -> mock.MagicMock:
+    stream = mock.MagicMock()
+    stream.__iter__.return_value = iter(chunks)
+    return stream
+
+
+class DeployTest(SimpleTestCase):
+
+    def test_runtime_image_is_built_once(self):
+        client = mock.Mock()
+        client.images.get.side_effect = docker.errors.ImageNotFound("missing")
+
+        tag = _ensure_runtime_image(client)
+
+        self.assertTrue(tag.startswith(f"{settings.BOT_RUNTIME_IMAGE}:"))
+        client.images.build.assert_called_once()
+        self.assertEqual(client.images.build.call_args.kwargs["tag"], tag)
+
+        client.images.get.side_effect = None
+        client.images.build.reset_mock()
+        self.assertEqual(_ensure_runtime_image(client), tag)
+        client.images.build.assert_not_called()
+
+    def test_reload_running_container(self):
+        client = mock.Mock()
+        tag = _ensure_runtime_image(client)
+        container = client.containers.get.return_value
+        container.status = "running"
+        container.attrs = {"Config": {"Image": tag}}
+
+        _reload_bot(client, 1, "print('reloaded')")
+
+        container.put_archive.assert_called_once()
+        path, archive = container.put_archive.call_args.args
+        self.assertEqual(path, "/app")
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            self.assertEqual(
+                tar.extractfile("main.py").read(),
+                b"print('reloaded')",
+            )
+        container.kill.assert_called_once_with(signal="SIGHUP")
+        client.containers.create.assert_not_called()
+
+    def test_bots_are_assigned_to_hosts_with_room(self):
+        bot_ids = [10**9 + 1, 10**9 + 2, 10**9 + 3]
+        get_client_patch = mock.patch("bot.tasks.get_client")
+        get_client_patch.start()
+        self.addCleanup(get_client_patch.stop)
+        self.addCleanup(
+            lambda: [_release_shared_host(bot_id) for bot_id in bot_ids],
+        )
+
+        with self.settings(BOT_HOST_COUNT=2, BOT_HOST_CAPACITY=1):
+            self.assertEqual(_assign_host(bot_ids[0]), "bot-host-0")
+            self.assertEqual(_assign_host(bot_ids[0]), "bot-host-0")
+            self.assertEqual(_assign_host(bot_ids[1]), "bot-host-1")
+            with self.assertRaises(RuntimeError):
+                _assign_host(bot_ids[2])
+
+    def _swap_client(self, new_status: str) -> tuple:
+        client = mock.Mock()
+        old_container = mock.Mock()
+
+        def get_container(name: str) -> mock.Mock:
+            if name != "bot-container-1":
+                raise docker.errors.NotFound(name)
+            return old_container
+
+        client.containers.get.side_effect = get_container
+        new_container = client.containers.run.return_value
+        new_container.status = new_status
+        new_container.exec_run.return_value.exit_code = 0
+        new_container.logs.return_value = b"Unauthorized"
+        return client, old_container, new_container
+
+    def test_swap_retires_old_container_once_new_one_is_ready(self):
+        client, old_container, new_container = self._swap_client("running")
+
+        _swap_container(client, 1, "bot-1:abc")
+
+        self.assertEqual(
+            client.containers.run.call_args.kwargs["name"],
+            "bot-container-1-next",
+        )
+        old_container.stop.assert_called_once()
+        old_container.remove.assert_called_once()
+        new_container.rename.assert_called_once_with("bot-container-1")
+
+    def test_swap_rolls_back_when_new_container_exits(self):
+        client, old_container, new_container = self._swap_client("exited")
+
+        with self.assertRaisesMessage(RuntimeError, "Unauthorized"):
+            _swap_container(client, 1, "bot-1:abc")
+
+        new_container.remove.assert_called_once_with(force=True)
+        old_container.stop.assert_not_called()
+        new_container.rename.assert_not_called()
+
+    def test_bot_images_are_built_from_an_in_memory_context(self):
+        client = mock.Mock()
+        client.images.get.side_effect = docker.errors.ImageNotFound("missing")
+        client.images.build.return_value = (mock.Mock(id="image-id"), [])
+        deployment = mock.Mock(bot_id=1, code_hash="0123456789abcdef")
+
+        with (
+            mock.patch("bot.tasks._ensure_runtime_image", return_value="runtime:1"),
+            mock.patch("bot.tasks._swap_container") as swap_mock,
+        ):
+            _deploy_image(client, deployment, "print('hi')")
+
+        kwargs = client.images.build.call_args.kwargs
+        self.assertTrue(kwargs["custom_context"])
+        self.assertNotIn("path", kwargs)
+        with tarfile.open(fileobj=kwargs["fileobj"]) as tar:
+            self.assertEqual(sorted(tar.getnames()), ["Dockerfile", "main.py"])
+            self.assertEqual(tar.extractfile("main.py").read(), b"print('hi')")
+        swap_mock.assert_called_once_with(client, 1, "bot-1:0123456789ab")
+
+    def test_update_streams_report_backlog_and_lag(self):
+        # the streams are kept in the redis of the bots, not in the one of the app
+        bot_redis = Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=1)
+        stream = updates_stream_key(10**9 + 1)
+        self.addCleanup(bot_redis.delete, stream)
+        for update_id in range(3):
+            bot_redis.xadd(stream, {"update": json.dumps({"update_id": update_id})})
+        bot_redis.xgroup_create(stream, UPDATES_GROUP, id="0")
+        bot_redis.xreadgroup(UPDATES_GROUP, "bot", {stream: ">"}, count=1)
+
+        with mock.patch("bot.updates.bot_redis_client", bot_redis):
+            metrics = get_update_metrics([10**9 + 1])[str(10**9 + 1)]
+
+        self.assertEqual(metrics["pending"], 1)
+        self.assertEqual(metrics["backlog"], 3)
+        self.assertGreaterEqual(metrics["lag"], 0)
+
+    def test_concurrent_builds_are_capped(self):
+        with self.settings(
+            DEPLOY_MAX_CONCURRENT_BUILDS=1,
+            DEPLOY_BUILD_WAIT_TIMEOUT=0,
+        ):
+            with build_slot("test-host"):
+                self.assertEqual(get_metrics()["running_builds"], {"test-host": 1})
+                with self.assertRaises(RuntimeError):
+                    with build_slot("test-host"):
+                        pass
+                # builds on other docker hosts have their own slots
+                with build_slot("other-host"):
+                    pass
+            with build_slot("test-host"):
+                pass
+            self.assertNotIn("test-host", get_metrics()["running_builds"])
+
+    def test_docker_clients_are_reused_until_unhealthy(self):
+        self.addCleanup(docker_client._clients.clear)
+        docker_client._clients.clear()
+
+        with (
+            mock.patch("bot.docker_client._create_client") as create_mock,
+            self.settings(DOCKER_HEALTHCHECK_INTERVAL=0),
+        ):
+            create_mock.side_effect = lambda base_url: mock.Mock()
+            client = docker_client.get_client("tcp://docker-1:2375")
+            self.assertIs(docker_client.get_client("tcp://docker-1:2375"), client)
+            self.assertIsNot(docker_client.get_client("tcp://docker-2:2375"), client)
+
+            client.ping.side_effect = docker.errors.APIError("unreachable")
+            replaced = docker_client.get_client("tcp://docker-1:2375")
+
+        self.assertIsNot(replaced, client)
+        client.close.assert_called_once()
+        self.assertEqual(create_mock.call_count, 3)
+
+    def test_logs_are_read_in_pages_after_the_cursor(self):
+        container = mock.Mock()
+        container.logs.return_value = (
+            b"2025-01-01T00:00:00.000000001Z one\n2025-01-01T00:00:00.000000002Z two\n"
+        )
+        self.assertEqual(
+            read_logs(container, 2),
+            (
+                [
+                    ("2025-01-01T00:00:00.000000001Z", "one"),
+                    ("2025-01-01T00:00:00.000000002Z", "two"),
+                ],
+                False,
+            ),
+        )
+        container.logs.assert_called_once_with(tail=2, timestamps=True)
+
+        # docker resends the lines of the second of the cursor, split over chunks
+        container.logs.return_value = log_stream(
+            b"2025-01-01T00:00:00.000000002Z two\n2025-01-01T00:00:01.0",
+            b"00000000Z three\n2025-01-01T00:00:02.000000000Z four\n",
+        )
+        lines, has_more = read_logs(
+            container,
+            1,
+            cursor="2025-01-01T00:00:00.000000002Z",
+        )
+        self.assertEqual(lines, [("2025-01-01T00:00:01.000000000Z", "three")])
+        self.assertTrue(has_more)
+        self.assertEqual(container.logs.call_args.kwargs["since"], 1735689600)
+        # a followed log would block until new lines are written
+        self.assertIs(container.logs.call_args.kwargs["follow"], False)
+        container.logs.return_value.close.assert_called_once()
+
+    def test_logs_are_streamed_as_events(self):
+        container = mock.Mock()
+        container.logs.side_effect = [
+            b"2025-01-01T00:00:00.000000001Z one\n",
+            log_stream(b"2025-01-01T00:00:00.000000001Z one\n"),
+        ]
+
+        with (
+            self.settings(BOT_LOG_STREAM_TIMEOUT=1, BOT_LOG_POLL_INTERVAL=0),
+            mock.patch("bot.logs.time.monotonic", side_effect=[0, 0, 1]),
+        ):
+            events = list(iter_log_events(container, 10))
+
+        self.assertEqual(
+            events,
+            ["id: 2025-01-01T00:00:00.000000001Z\ndata: one\n\n", ": keepalive\n\n"],
+        )
@@ -0,0 +1,78 @@
+import time
+from typing import Iterable, Optional
+
+from django.conf import settings
+from redis.exceptions import ResponseError
+
+from utils.redis import bot_redis_client
+
+UPDATES_STREAM_PREFIX = "updates::bot::"
+# consumer group the bots read their update streams with
+UPDATES_GROUP = "bot"
+
+
+def updates_stream_key(bot_id: int) -> str:
+    return f"{UPDATES_STREAM_PREFIX}{bot_id}"
+
+
+def updates_offset_key(bot_id: int) -> str:
+    """Offset of the next update the gateway polls for the bot, see gateway.txt."""
+    return f"updates::offset::{bot_id}"
+
+
+def _entry_time(entry_id: bytes) -> float:
+    """Stream entry ids start with the unix time in milliseconds they were added at."""
+    return int(entry_id.split(b"-")[0]) / 1000
+
+
+def _stream_metrics(stream: str) -> Optional[dict]:
+    groups = bot_redis_client.xinfo_groups(stream)
+    group = next((g for g in groups if g["name"] == UPDATES_GROUP.encode()), None)
+    if group is None:
+        return None
+
+    last_delivered = group["last-delivered-id"]
+    undelivered = group.get("lag")
+    if undelivered is None:
+        # redis before 7 does not track the lag of groups
+        undelivered = len(
+            bot_redis_client.xrange(
+                stream,
+                b"(" + last_delivered,
+                "+",
+                count=settings.UPDATES_STREAM_MAXLEN,
+            ),
+        )
+
+    # the oldest update not handled yet, delivered or not
+    oldest = []
+    if group["pending"]:
+        oldest.append(bot_redis_client.xpending(stream, UPDATES_GROUP)["min"])
+    first_undelivered = bot_redis_client.xrange(
+        stream,
+        b"(" + last_delivered,
+        "+",
+        count=1,
+    )
+    if first_undelivered:
+        oldest.append(first_undelivered[0][0])
+
+    return {
+        "pending": group["pending"],
+        "backlog": group["pending"] + undelivered,
+        "lag": time.time() - min(map(_entry_time, oldest)) if oldest else 0.0,
+    }
+
+
+def get_update_metrics(bot_ids: Iterable[int]) -> dict:
+    """Backlog and lag in seconds of the update streams of the bots, by bot id."""
+    metrics = {}
+    for bot_id in bot_ids:
+        try:
+            bot_metrics = _stream_metrics(updates_stream_key(bot_id))
+        except ResponseError:
+            # the bot is not on the stream runtime
+            continue
+        if bot_metrics is not None:
+            metrics[str(bot_id)] = bot_metrics
+    return metrics
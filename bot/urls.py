@@ -4,9 +4,12 @@ from bot.views import (
     CreateBotView,
     DeleteUpdateBot,
     Deploy,
+    DeploymentDetailView,
+    DeploymentListView,
     GenerateCodeView,
     Log,
     MyBots,
+    UpdateMetricsView,
 )
 
 urlpatterns = [
@@ -15,5 +18,16 @@ urlpatterns = [
     path("my-bots/<int:pk>/", DeleteUpdateBot.as_view(), name="delete-bot"),
     path("<int:bot>/generate-code/", GenerateCodeView.as_view(), name="generate-code"),
     path("<int:bot>/deploy/", Deploy.as_view(), name="deploy"),
+    path(
+        "<int:bot>/deployments/",
+        DeploymentListView.as_view(),
+        name="deployments",
+    ),
+    path(
+        "<int:bot>/deployments/<int:pk>/",
+        DeploymentDetailView.as_view(),
+        name="deployment",
+    ),
     path("<int:bot>/log/", Log.as_view(), name="log"),
+    path("update-metrics/", UpdateMetricsView.as_view(), name="update-metrics"),
 ]
@@ -1,33 +1,62 @@
+import json
 import logging
 import os
 import shutil
+from typing import Any, Optional
 
 import docker
 import requests
 from django.conf import settings
 from django.db.models import QuerySet
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import (
+    HttpResponse,
+    HttpResponseBadRequest,
+    StreamingHttpResponse,
+)
+from django.utils.cache import get_conditional_response
 from rest_framework import status
+from rest_framework.authentication import SessionAuthentication
 from rest_framework.exceptions import ValidationError
 from rest_framework.generics import (
     DestroyAPIView,
     ListAPIView,
+    RetrieveAPIView,
     RetrieveDestroyAPIView,
     UpdateAPIView,
 )
+from rest_framework.permissions import IsAdminUser
+from rest_framework.renderers import BaseRenderer
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.serializers import BaseSerializer
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from bot.models import Bot
+from bot.docker_client import get_bot_client
+from bot.logs import cursor_since, iter_log_events, read_logs
+from bot.models import Bot, Deployment
 from bot.permissions import IsBotOwner
+from bot.runtime import RUNTIMES, STORAGES
+from bot.scheduler import get_metrics
 from bot.serializers import (
     CreateBotRequestSerializer,
     CreateBotResponseSerializer,
+    DeploymentSerializer,
     MyBotsResponseSerializer,
 )
-from bot.services import generate_code
-from bot.tasks import deploy_bot
+from bot.services import (
+    code_fingerprint,
+    get_code_artifact,
+    get_code_artifact_error,
+    stream_code,
+)
+from bot.tasks import (
+    enqueue_deploy_bot,
+    enqueue_generate_bot_code,
+    release_gateway,
+    release_webhook,
+)
+from bot.updates import get_update_metrics
 from iam.permissions import IsLoginedPermission
 
 logger = logging.getLogger(__name__)
@@ -85,6 +114,20 @@ class DeleteUpdateBot(DestroyAPIView, UpdateAPIView):
     def get_queryset(self) -> QuerySet:
         return Bot.objects.filter(user=self.request.iam_user)
 
+    def perform_update(self, serializer: BaseSerializer) -> None:
+        token = serializer.instance.token
+        super().perform_update(serializer)
+        Bot.bump_version(serializer.instance.id)
+        if serializer.instance.token != token:
+            release_gateway.delay(serializer.instance.id)
+            release_webhook.delay(serializer.instance.id)
+
+    def perform_destroy(self, instance: Bot) -> None:
+        bot_id = instance.id
+        super().perform_destroy(instance)
+        release_gateway.delay(bot_id)
+        release_webhook.delay(bot_id)
+
 
 class GenerateCodeView(APIView):
     permission_classes = [IsLoginedPermission, IsBotOwner]
@@ -97,9 +140,48 @@ class GenerateCodeView(APIView):
                 "Bot not found or you don't have permission to access it",
             )
 
-        code = generate_code(bot_instance)
+        runtime = request.query_params.get("runtime", settings.BOT_RUNTIME)
+        if runtime not in RUNTIMES:
+            raise ValidationError(f"runtime must be one of {', '.join(RUNTIMES)}")
+        # downloaded bots run on their own, they do not reach the redis of the bots
+        storage = request.query_params.get("storage", settings.BOT_DOWNLOAD_STORAGE)
+        if storage not in STORAGES:
+            raise ValidationError(f"storage must be one of {', '.join(STORAGES)}")
+
+        if request.query_params.get("stream") in ("1", "true"):
+            # functions are sent as they are generated, tell nginx not to buffer them
+            response = StreamingHttpResponse(
+                stream_code(bot_instance, runtime, storage),
+                content_type="text/x-python",
+            )
+            response["X-Accel-Buffering"] = "no"
+        else:
+            fingerprint = code_fingerprint(bot_instance, runtime, storage)
+            etag = f'"{fingerprint}"'
+            # If-None-Match may list several tags, weakened ones of gzipped responses
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                not_modified["ETag"] = etag
+                return not_modified
+
+            code = get_code_artifact(bot_instance, fingerprint)
+            error = get_code_artifact_error(bot_instance, fingerprint)
+            if code is None and error is None:
+                # generation runs in a worker, polling this url returns the code
+                task_id = enqueue_generate_bot_code(bot_instance.id, runtime, storage)
+                code = get_code_artifact(bot_instance, fingerprint)
+                error = get_code_artifact_error(bot_instance, fingerprint)
+                if code is None and error is None:
+                    return Response(
+                        {"status": "pending", "task_id": task_id},
+                        status=status.HTTP_202_ACCEPTED,
+                    )
+            if code is None:
+                raise ValidationError(error)
+
+            response = HttpResponse(code, content_type="text/x-python")
+            response["ETag"] = etag
 
-        response = HttpResponse(code, content_type="text/x-python")
         response["Content-Disposition"] = 'attachment; filename="bot.py"'
         return response
 
@@ -113,25 +195,94 @@ class Deploy(APIView):
                 "Bot not found or you don't have permission to access it",
             )
 
-        try:
-            code = generate_code(bot_instance)
-        except:
-            raise ValidationError("GenerateCodeFailed")
-
-        # Launch the deployment task asynchronously
-        task = deploy_bot.delay(bot, code)
+        # Launch the deployment task asynchronously, the code is generated by it
+        deployment = enqueue_deploy_bot(bot_instance.id)
 
         return Response(
             {
                 "message": f"Bot {bot} deployment has been initiated.",
-                "task_id": task.id,
+                "task_id": deployment.task_id,
+                "deployment": DeploymentSerializer(deployment).data,
             },
             status=status.HTTP_202_ACCEPTED,
         )
 
 
+class DeploymentListView(ListAPIView):
+    """Latest deployments of the bot, with the progress of the running one."""
+
+    permission_classes = [IsLoginedPermission, IsBotOwner]
+    serializer_class = DeploymentSerializer
+
+    def get_queryset(self) -> QuerySet:
+        return Deployment.objects.filter(
+            bot=self.kwargs.get("bot"),
+            bot__user=self.request.iam_user,
+        )[: settings.DEPLOYMENT_HISTORY_LIMIT]
+
+
+class DeploymentDetailView(RetrieveAPIView):
+    permission_classes = [IsLoginedPermission, IsBotOwner]
+    serializer_class = DeploymentSerializer
+
+    def get_queryset(self) -> QuerySet:
+        return Deployment.objects.filter(
+            bot=self.kwargs.get("bot"),
+            bot__user=self.request.iam_user,
+        )
+
+
+class DeployMetricsView(APIView):
+    """
+    Depth of the deploy queue, running image builds and deploy stage durations. They
+    are those of every user and name the docker hosts, only the staff logged in to
+    the admin see them.
+    """
+
+    authentication_classes = [SessionAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request: Request) -> Response:
+        return Response(get_metrics())
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Accepts EventSource requests, errors are rendered as JSON."""
+
+    media_type = "text/event-stream"
+    format = "event-stream"
+
+    def render(
+        self,
+        data: Any,
+        accepted_media_type: Optional[str] = None,
+        renderer_context: Optional[dict] = None,
+    ) -> bytes:
+        return json.dumps(data).encode()
+
+
+class UpdateMetricsView(APIView):
+    """Backlog and lag of the update streams of the bots of the user."""
+
+    permission_classes = [IsLoginedPermission]
+
+    def get(self, request: Request) -> Response:
+        bot_ids = Bot.objects.filter(user=request.iam_user).values_list("id", flat=True)
+        return Response(get_update_metrics(bot_ids))
+
+
 class Log(APIView):
-    def get(self, request: Request, bot: int) -> Response:
+    """
+    The last `tail` lines of the bot log, or the lines after `since` (unix time) or a
+    `cursor` from a previous response. `stream=1` follows the log as server-sent
+    events for BOT_LOG_STREAM_TIMEOUT seconds, clients resume with the Last-Event-ID
+    header. A stream occupies a whole sync worker, serve it with threaded or async
+    workers.
+    """
+
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, EventStreamRenderer]
+
+    def get(self, request: Request, bot: int) -> HttpResponse:
         try:
             bot_instance = Bot.objects.get(id=bot, user=request.iam_user)
         except Bot.DoesNotExist:
@@ -139,12 +290,47 @@ class Log(APIView):
                 "Bot not found or you don't have permission to access it",
             )
 
-        client = docker.from_env()
-        container_name = f"bot-container-{bot}"
-        container = client.containers.get(container_name)
-        logs = container.logs().decode("utf-8")
+        params = request.query_params
+        try:
+            tail = int(params.get("tail", settings.BOT_LOG_TAIL))
+            since = float(params["since"]) if "since" in params else None
+        except ValueError:
+            raise ValidationError("tail and since must be numbers")
+        if tail < 1:
+            raise ValidationError("tail must be positive")
+        tail = min(tail, settings.BOT_LOG_MAX_LINES)
+
+        stream = params.get("stream") in ("1", "true")
+        cursor = params.get("cursor")
+        if stream and cursor is None:
+            cursor = request.headers.get("Last-Event-ID")
+        if cursor is not None:
+            try:
+                cursor_since(cursor)
+            except ValueError:
+                raise ValidationError("Invalid cursor")
 
+        client = get_bot_client(bot_instance.id)
+        try:
+            container = client.containers.get(f"bot-container-{bot}")
+        except docker.errors.NotFound:
+            raise ValidationError("Bot is not deployed")
+
+        if stream:
+            response = StreamingHttpResponse(
+                iter_log_events(container, tail, since, cursor),
+                content_type="text/event-stream",
+            )
+            response["Cache-Control"] = "no-cache"
+            response["X-Accel-Buffering"] = "no"
+            return response
+
+        lines, has_more = read_logs(container, tail, since, cursor)
         return Response(
-            {"logs": logs},
+            {
+                "logs": "\n".join(line for _, line in lines),
+                "cursor": lines[-1][0] if lines else cursor,
+                "has_more": has_more,
+            },
             status=status.HTTP_200_OK,
         )
@@ -0,0 +1,82 @@
+import hashlib
+import json
+from typing import Dict, Iterable
+
+from django.conf import settings
+from django.forms.models import model_to_dict
+
+from component.graph import ComponentGraph
+from component.models import Component
+from utils.redis import redis_client
+
+# Bump whenever the shape of the generated code changes so old snippets are ignored.
+CODEGEN_CACHE_VERSION = 9
+
+
+def _cache_key(pk: int) -> str:
+    return f"codegen::{pk}"
+
+
+def component_hash(component: Component, graph: ComponentGraph) -> str:
+    """
+    Hash of everything a component's generated snippet depends on: its field values,
+    its markup and the functions it calls.
+    """
+    markup = graph.markup(component)
+    content = {
+        "version": CODEGEN_CACHE_VERSION,
+        "site_url": settings.SITE_URL,
+        "black": settings.CODEGEN_BLACK_FORMAT,
+        "class": component.__class__.__name__,
+        "fields": model_to_dict(
+            component,
+            exclude=["position_x", "position_y", "component_name"],
+        ),
+        "markup": markup and [markup.markup_type, markup.buttons],
+        "linked": [
+            linked_component.code_function_name
+            for linked_component in component.get_linked_components(graph)
+        ],
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, default=str).encode(),
+    ).hexdigest()
+
+
+def get_snippets(hashes: Dict[int, str]) -> Dict[int, str]:
+    """
+    Returns the cached snippets whose stored hash still matches, `hashes` maps
+    component ids to their current `component_hash`.
+    """
+    if not hashes:
+        return {}
+
+    snippets = {}
+    cached = redis_client.mget([_cache_key(pk) for pk in hashes])
+    for (pk, content_hash), value in zip(hashes.items(), cached):
+        if value is None:
+            continue
+        value = json.loads(value)
+        if value["hash"] == content_hash:
+            snippets[pk] = value["code"]
+    return snippets
+
+
+def set_snippets(snippets: Dict[int, str], hashes: Dict[int, str]) -> None:
+    if not snippets:
+        return
+
+    pipeline = redis_client.pipeline()
+    for pk, code in snippets.items():
+        pipeline.set(
+            _cache_key(pk),
+            json.dumps({"hash": hashes[pk], "code": code}),
+            ex=settings.CODEGEN_CACHE_TTL,
+        )
+    pipeline.execute()
+
+
+def invalidate_snippets(pks: Iterable[int | None]) -> None:
+    keys = [_cache_key(pk) for pk in pks if pk is not None]
+    if keys:
+        redis_client.delete(*keys)
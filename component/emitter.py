@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+from typing import Iterator, List
+
+
+class CodeEmitter:
+    """
+    Indentation aware line builder for generated bot code.
+
+    Blocks always get a body and top level definitions are separated by two blank
+    lines, so the emitted code is well-formed without running a formatter on it.
+    """
+
+    INDENT = "    "
+
+    def __init__(self) -> None:
+        self.lines: List[str] = []
+        self.level = 0
+
+    def line(self, text: str = "") -> "CodeEmitter":
+        """Adds one logical line, which may span several lines inside a string."""
+        self.lines.append(self.INDENT * self.level + text if text else "")
+        return self
+
+    def code(self, text: str) -> "CodeEmitter":
+        """Adds a piece of source code, indenting every line of it."""
+        for line in text.strip("\n").splitlines():
+            self.line(line.rstrip())
+        return self
+
+    def comment(self, text: str) -> "CodeEmitter":
+        for line in text.splitlines() or [""]:
+            self.line(f"# {line}".rstrip())
+        return self
+
+    def separate(self) -> "CodeEmitter":
+        """Starts a new top level definition."""
+        while self.lines and not self.lines[-1]:
+            self.lines.pop()
+        if self.lines:
+            self.lines.extend(["", ""])
+        return self
+
+    @contextmanager
+    def block(self, header: str) -> Iterator["CodeEmitter"]:
+        self.line(header)
+        self.level += 1
+        start = len(self.lines)
+        yield self
+        if len(self.lines) == start:
+            self.line("pass")
+        self.level -= 1
+
+    @contextmanager
+    def bracket(self, opening: str, closing: str) -> Iterator["CodeEmitter"]:
+        self.line(opening)
+        self.level += 1
+        yield self
+        self.level -= 1
+        self.line(closing)
+
+    def render(self) -> str:
+        return "\n".join(self.lines).strip("\n")
+
+
+def format_code(code: str) -> str:
+    """Lints generated code with black, black is only imported when this is used."""
+    import black
+
+    return black.format_str(code, mode=black.Mode())
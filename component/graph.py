@@ -0,0 +1,101 @@
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from django.contrib.contenttypes.models import ContentType
+
+from component.models import Component, Markup
+
+
+class ComponentGraph:
+    """
+    In-memory index of every component of a bot.
+
+    The graph is loaded with one query for the base `Component` rows, one query per
+    concrete component class present in the bot and one query for the markups.
+    Code generation reads components, children and markups from here instead of
+    hitting the ORM for every node.
+    """
+
+    def __init__(self, components: Dict[int, Component], markups: Dict[int, Markup]):
+        self.components = components
+        self.markups = markups
+        self.children: Dict[int, List[Component]] = defaultdict(list)
+
+        for pk in sorted(components):
+            component = components[pk]
+            if component.previous_component_id in components:
+                self.children[component.previous_component_id].append(component)
+
+    @classmethod
+    def load(cls, bot_id: int) -> "ComponentGraph":
+        ids_by_content_type = defaultdict(list)
+        for pk, content_type_id in Component.objects.filter(bot_id=bot_id).values_list(
+            "id",
+            "component_content_type_id",
+        ):
+            ids_by_content_type[content_type_id].append(pk)
+
+        components = {}
+        for content_type_id, ids in ids_by_content_type.items():
+            model_class = Component
+            if content_type_id is not None:
+                model_class = (
+                    ContentType.objects.get_for_id(content_type_id).model_class()
+                    or Component
+                )
+            for component in model_class.objects.filter(pk__in=ids):
+                components[component.pk] = component
+
+        markups = {}
+        for markup in Markup.objects.filter(parent_component__bot_id=bot_id):
+            # prime the relation cache so markups never query their parent again
+            markup.parent_component = components[markup.parent_component_id]
+            markups[markup.parent_component_id] = markup
+
+        return cls(components, markups)
+
+    def get(self, pk: int) -> Component:
+        """Returns the concrete component instance for the given id."""
+        try:
+            return self.components[pk]
+        except KeyError:
+            raise Component.DoesNotExist(f"Component with id {pk} does not exist")
+
+    def next_components(self, component: Component) -> List[Component]:
+        return self.children.get(component.pk, [])
+
+    def markup(self, component: Component) -> Optional[Markup]:
+        return self.markups.get(component.pk)
+
+    def triggers(self) -> List[Component]:
+        return [
+            self.components[pk]
+            for pk in sorted(self.components)
+            if self.components[pk].component_type == Component.ComponentType.TRIGGER
+        ]
+
+    def all_linked_components(
+        self,
+        component: Component,
+        emitted: Optional[Dict[int, str]] = None,
+    ) -> List[Component]:
+        """
+        Every component reachable from `component` through next components, switch
+        branches and markup buttons, in depth first order.
+
+        `emitted` is a memo of the function names already emitted in the current
+        generation, components found in it are skipped and new ones are added, so
+        shared subgraphs are only returned for the first component reaching them.
+        """
+        emitted = {} if emitted is None else emitted
+        ans = []
+        stack = [self.get(component.pk)]
+        while stack:
+            current = stack.pop()
+            if current.pk not in emitted:
+                emitted[current.pk] = current.code_function_name
+                ans.append(current)
+                for linked_component in current.get_linked_components(self):
+                    if linked_component.pk not in emitted:
+                        stack.append(linked_component)
+        return ans
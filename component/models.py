@@ -1,9 +1,22 @@
-from typing import Any
+import ast
+from typing import Any, List
 
 from django.core.exceptions import ValidationError
 
+from component.emitter import CodeEmitter
 from component.telegram.models import *
 
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _base36(number: int) -> str:
+    digits = ""
+    while True:
+        number, digit = divmod(number, 36)
+        digits = BASE36_DIGITS[digit] + digits
+        if not number:
+            return digits
+
 
 class SwitchComponent(Component):
     """Use this method to create a switch component. Returns True on success."""
@@ -31,47 +44,43 @@ class SwitchComponent(Component):
     #         ),
     #     ]
 
-    def generate_code(self) -> str:
+    def generate_code(
+        self,
+        graph: "ComponentGraph | None" = None,
+        emitter: CodeEmitter | None = None,
+    ) -> str:
         if len(self.values) != len(self.next_components):
             raise ValidationError(
                 "Values and next_components must have the same length",
             )
 
-        base_code = ""
-        code = [
+        graph = self._get_graph(graph)
+        emitter = emitter or CodeEmitter()
+
+        emitter.separate()
+        with emitter.block(
             f"async def {self.code_function_name}(message: Message, **kwargs):",
-            f"    value = message{self.expression}",
-            f"    match value:",
+        ):
+            emitter.line(f"value = message{self.expression}")
+            with emitter.block("match value:"):
+                for value, next_component in zip(self.values, self.next_components):
+                    next_component = graph.get(next_component)
+                    with emitter.block(f"case {value!r}:"):
+                        emitter.line(
+                            f"await {next_component.code_function_name}(message, **kwargs)",
+                        )
+
+                # Add default case
+                with emitter.block("case _:"):
+                    emitter.line("pass  # No matching case found")
+
+        return emitter.render()
+
+    def get_linked_components(self, graph: "ComponentGraph") -> List[Component]:
+        return super().get_linked_components(graph) + [
+            graph.get(next_component) for next_component in self.next_components
         ]
 
-        for value, next_component in zip(self.values, self.next_components):
-            next_component = Component.objects.get(
-                pk=next_component,
-            )
-            next_component = (
-                next_component.component_content_type.model_class().objects.get(
-                    pk=next_component.pk,
-                )
-            )
-            base_code += next_component.generate_code() + "\n"
-            code.extend(
-                [
-                    f"        case '{value}':",
-                    f"            await {next_component.code_function_name}(message, **kwargs)",
-                ],
-            )
-
-        # Add default case
-        code.extend(
-            [
-                "        case _:",
-                "            pass  # No matching case found",
-            ],
-        )
-
-        base_code += "\n".join(code)
-        return base_code
-
     @property
     def required_fields(self) -> list:
         return ["expression", "values"]
@@ -91,28 +100,59 @@ class CodeComponent(Component):
     def required_fields(self) -> list:
         return ["code"]
 
-    def _format_code_component(self, underlying_object) -> list[str]:
+    def _format_code_component(self, underlying_object, emitter: CodeEmitter) -> None:
         if not underlying_object.code:
-            return ["    pass  # No code provided"]
+            emitter.line("pass  # No code provided")
+            return
 
         try:
-            import black
-
-            formatted_code = black.format_str(underlying_object.code, mode=black.Mode())
-            return [f"    {formatted_code}"]
-        except Exception as e:
-            return [
-                f"    # Original code failed black formatting: {str(e)}",
-                f"    # {underlying_object.code}",
-                "    pass",
-            ]
-
-    def generate_code(self) -> str:
-        code = [
+            ast.parse(underlying_object.code)
+        except SyntaxError as e:
+            emitter.comment(f"Original code has a syntax error: {e}")
+            emitter.comment(underlying_object.code)
+            emitter.line("pass")
+            return
+
+        emitter.code(underlying_object.code)
+
+    def _format_data_dict_code(self, emitter: CodeEmitter) -> None:
+        # bots used to keep user data in a global data_dict, code using it gets the
+        # data of the user and the keys it changes are set once it is done
+        emitter.line("_stored_data = await data_store.get(message.from_user.id)")
+        emitter.line(
+            "data_dict = {message.from_user.id: "
+            "await data_store.get(message.from_user.id)}",
+        )
+        with emitter.block("try:"):
+            self._format_code_component(self, emitter)
+        with emitter.block("finally:"):
+            with emitter.block(
+                "for _key, _value in data_dict.get(message.from_user.id, {}).items():",
+            ):
+                with emitter.block(
+                    "if _key not in _stored_data or _stored_data[_key] != _value:",
+                ):
+                    emitter.line(
+                        "await data_store.set(message.from_user.id, _key, _value)",
+                    )
+
+    def generate_code(
+        self,
+        graph: "ComponentGraph | None" = None,
+        emitter: CodeEmitter | None = None,
+    ) -> str:
+        emitter = emitter or CodeEmitter()
+
+        emitter.separate()
+        with emitter.block(
             f"async def {self.code_function_name}(message: Message, **kwargs):",
-            *self._format_code_component(self),
-        ]
-        return "\n".join(code)
+        ):
+            if self.code and "data_dict" in self.code:
+                self._format_data_dict_code(emitter)
+            else:
+                self._format_code_component(self, emitter)
+
+        return emitter.render()
 
 
 class SetState(Component):
@@ -134,27 +174,29 @@ class SetState(Component):
     def required_fields(self) -> list:
         return ["state"]
 
-    def generate_code(self) -> str:
-        underlying_object: SetState = (
-            self.component_content_type.model_class().objects.get(pk=self.pk)
-        )
-
-        code = [
+    def generate_code(
+        self,
+        graph: "ComponentGraph | None" = None,
+        emitter: CodeEmitter | None = None,
+    ) -> str:
+        graph = self._get_graph(graph)
+        emitter = emitter or CodeEmitter()
+        underlying_object: SetState = graph.get(self.pk)
+
+        emitter.separate()
+        with emitter.block(
             f"async def {self.code_function_name}(message: Message, **kwargs):",
-            f"    await kwargs['state'].set_state('{underlying_object.state}')",
-        ]
+        ):
+            emitter.line(
+                f"await kwargs['state'].set_state({underlying_object.state!r})",
+            )
 
-        for next_component in underlying_object.next_component.all():
-            next_component = (
-                next_component.component_content_type.model_class().objects.get(
-                    pk=next_component.pk,
+            for next_component in graph.next_components(underlying_object):
+                emitter.line(
+                    f"await {next_component.code_function_name}(message, **kwargs)",
                 )
-            )
-            code.append(
-                f"    await {next_component.code_function_name}(message, **kwargs)",
-            )
 
-        return "\n".join(code)
+        return emitter.render()
 
 
 class OnMessage(Component):
@@ -190,13 +232,22 @@ class OnMessage(Component):
         """Build text matching filter based on configuration."""
         if regex:
             # For regex, use regexp function
-            return f"F.text.regexp(r'{text}')"
+            return f"F.text.regexp({text!r})"
         else:
             # For exact text matching, handle case sensitivity
             if case_sensitive:
-                return f"F.text == '{text}'"
+                return f"F.text == {text!r}"
             else:
-                return f"F.text.lower() == '{text.lower()}'"
+                return f"F.text.lower() == {text.lower()!r}"
+
+    def _build_text_route(self, function_name: str) -> str:
+        """Registers the handler with the text router of the bot, see main.txt."""
+        if self.regex:
+            return f"text_router.add_pattern({self.text!r}, {function_name})"
+        return (
+            f"text_router.add_text({self.text!r}, {function_name}, "
+            f"case_sensitive={self.case_sensitive})"
+        )
 
     def _build_state_filter(self, state_string: str) -> str:
         """Build state matching filter from comma-separated state list."""
@@ -209,15 +260,33 @@ class OnMessage(Component):
             return ""
 
         # Build lambda filter for state matching
-        state_list = [f"'{state}'" for state in states]
+        state_list = [repr(state) for state in states]
         return f"lambda _, raw_state: raw_state in [{', '.join(state_list)}]"
 
-    def generate_code(self) -> str:
-        underlying_object: OnMessage = (
-            self.component_content_type.model_class().objects.get(pk=self.pk)
-        )
-        if underlying_object.next_component.count() == 0:
-            return ""
+    def generate_code(
+        self,
+        graph: "ComponentGraph | None" = None,
+        emitter: CodeEmitter | None = None,
+    ) -> str:
+        graph = self._get_graph(graph)
+        emitter = emitter or CodeEmitter()
+        underlying_object: OnMessage = graph.get(self.pk)
+        if not graph.next_components(underlying_object):
+            return emitter.render()
+
+        # triggers on a text alone are looked up by the text router instead of being
+        # tried one by one by the dispatcher
+        if underlying_object.text and not underlying_object.state:
+            emitter.separate()
+            with emitter.block(
+                f"async def {self.code_function_name}(message: Message, **kwargs):",
+            ):
+                for next_component in graph.next_components(underlying_object):
+                    emitter.line(
+                        f"await {next_component.code_function_name}(message, **kwargs)",
+                    )
+            emitter.line(underlying_object._build_text_route(self.code_function_name))
+            return emitter.render()
 
         filters = []
         if underlying_object.text:
@@ -234,24 +303,20 @@ class OnMessage(Component):
                 filters.append(state_filter)
 
         filter_str = ", ".join(filters) if filters else ""
-        code = [
-            f"@dp.message({filter_str})",
+        emitter.separate()
+        emitter.line(f"@dp.message({filter_str})")
+        with emitter.block(
             f"async def {self.code_function_name}(message: Message, **kwargs):",
-        ]
-
-        if underlying_object.state:
-            code.append("    await kwargs['state'].clear()")
+        ):
+            if underlying_object.state:
+                emitter.line("await kwargs['state'].clear()")
 
-        for next_component in underlying_object.next_component.all():
-            next_component = (
-                next_component.component_content_type.model_class().objects.get(
-                    pk=next_component.pk,
+            for next_component in graph.next_components(underlying_object):
+                emitter.line(
+                    f"await {next_component.code_function_name}(message, **kwargs)",
                 )
-            )
-            code.append(
-                f"    await {next_component.code_function_name}(message, **kwargs)",
-            )
-        return "\n".join(code)
+
+        return emitter.render()
 
 
 class Markup(models.Model):
@@ -295,12 +360,9 @@ class Markup(models.Model):
                         f"Button value at row {row_idx}, column {button_idx} must be a string",
                     )
 
-    def get_callback_data(self, cell: dict) -> str:
-        if not isinstance(cell, dict) or "value" not in cell:
-            raise ValidationError("Cell must be a dict with 'value' key")
-
-        value = cell["value"].replace(" ", "_")
-        return f"{self.parent_component.id}-{value}"
+    def get_callback_data(self, row: int, column: int) -> str:
+        """Compact callback data of the button, the ids are base36 encoded."""
+        return ".".join(map(_base36, (self.parent_component_id, row, column)))
 
     def save(self, *args: Any, **kwargs: Any) -> None:
         self.validate()
@@ -326,105 +388,117 @@ class Markup(models.Model):
 
         return config_map[self.markup_type]
 
-    def _generate_button_args(self, cell: dict) -> dict:
+    def _generate_button_args(self, cell: dict, row: int, column: int) -> dict:
         """Generates the arguments for a button."""
         args = {"text": cell["value"]}
         if self.markup_type == self.MarkupType.InlineKeyboard:
-            args["callback_data"] = self.get_callback_data(cell)
+            args["callback_data"] = self.get_callback_data(row, column)
         return args
 
-    def _generate_button_code(self, button_class: str, args: dict) -> str:
+    def _generate_button_code(
+        self,
+        button_class: str,
+        args: dict,
+        emitter: CodeEmitter,
+    ) -> None:
         """Generates the code for a single button."""
-        button_lines = [f"{button_class}("]
-        for k, v in args.items():
-            button_lines.append(f'    {k}="{v}",')
-        button_lines.append("),")
-        return "\n".join(button_lines)
+        with emitter.bracket(f"{button_class}(", "),"):
+            for k, v in args.items():
+                emitter.line(f"{k}={v!r},")
 
-    def _generate_callback_handlers(self, cell: dict) -> tuple[list[str], list[str]]:
-        """Generates callback handlers for a cell if needed."""
-        base_code = []
-        callback_code = []
-
-        first_next_component = cell.get("next_component")
-        if not first_next_component:
-            return base_code, callback_code
+    def get_next_components(self, graph: "ComponentGraph") -> List[Component]:
+        """Returns the components the buttons of this markup lead to."""
+        next_components = []
+        for row in self.buttons:
+            for cell in row:
+                if cell.get("next_component"):
+                    next_components.append(self._get_next_component(cell, graph))
+        return next_components
 
+    def _get_next_component(self, cell: dict, graph: "ComponentGraph") -> Component:
         try:
-            component_obj = Component.objects.get(id=first_next_component)
-            object = component_obj.component_content_type.model_class().objects.get(
-                pk=first_next_component,
-            )
+            return graph.get(cell["next_component"])
         except Component.DoesNotExist:
             raise ValidationError(
-                f"Component with id {first_next_component} does not exist",
+                f"Component with id {cell['next_component']} does not exist",
             )
 
+    def _generate_callback_handlers(
+        self,
+        cell: dict,
+        row: int,
+        column: int,
+        graph: "ComponentGraph",
+        emitter: CodeEmitter,
+    ) -> None:
+        """Generates callback handlers for a cell if needed."""
+        if not cell.get("next_component"):
+            return
+
+        object = self._get_next_component(cell, graph)
+        emitter.separate()
         if self.markup_type == self.MarkupType.InlineKeyboard:
-            callback_data = self.get_callback_data(cell)
-            callback_code.extend(
-                [
-                    f"@dp.callback_query(lambda callback_query: callback_query.data == '{callback_data}')",
-                    f"async def {object.code_function_name}_callback(callback_query: CallbackQuery, **kwargs):",
-                    f"    await {object.code_function_name}(callback_query, **kwargs)",
-                ],
+            # inline buttons send their callback data, it is looked up in callback_routes
+            with emitter.block(
+                f"async def {object.code_function_name}_callback(callback_query: CallbackQuery, **kwargs):",
+            ):
+                emitter.line(
+                    f"await {object.code_function_name}(callback_query, **kwargs)",
+                )
+            emitter.line(
+                f"callback_routes[{self.get_callback_data(row, column)!r}] = "
+                f"{object.code_function_name}_callback",
             )
         else:
-            callback_code.extend(
-                [
-                    f"@dp.message(F.text == '{cell['value']}')",
-                    f"async def {object.code_function_name}_handler(message: Message, **kwargs):",
-                    f"    await {object.code_function_name}(message, **kwargs)",
-                ],
+            # reply buttons send their text, it is looked up by the text router
+            with emitter.block(
+                f"async def {object.code_function_name}_handler(message: Message, **kwargs):",
+            ):
+                emitter.line(f"await {object.code_function_name}(message, **kwargs)")
+            emitter.line(
+                f"text_router.add_text({cell['value']!r}, {object.code_function_name}_handler)",
             )
 
-        # Generate code for all next components
-        try:
-            for next_component in Component.objects.get(
-                id=first_next_component,
-            ).get_all_next_components():
-                next_obj = (
-                    next_component.component_content_type.model_class().objects.get(
-                        pk=next_component.pk,
-                    )
-                )
-                base_code.append(next_obj.generate_code())
-        except AttributeError:
-            # get_all_next_components method might not exist
-            pass
-
-        return base_code, callback_code
-
-    def generate_code(self) -> tuple[str, list[str]]:
-        """Generates the keyboard markup code and callback handlers."""
-        base_code = []
-        callback_code = []
-
+    def generate_keyboard(self, emitter: CodeEmitter) -> None:
+        """Generates the `keyboard` variable holding the markup."""
         keyword_class, button_class, variable_name = self._get_markup_config()
 
-        keyboard_rows = []
-        for row in self.buttons:
-            row_buttons = []
-            for cell in row:
-                cell_base_code, cell_callback_code = self._generate_callback_handlers(
+        with emitter.bracket(f"keyboard = {keyword_class}(", ")"):
+            with emitter.bracket(f"{variable_name}=[", "],"):
+                for row_index, row in enumerate(self.buttons):
+                    with emitter.bracket("[", "],"):
+                        for column_index, cell in enumerate(row):
+                            button_args = self._generate_button_args(
+                                cell,
+                                row_index,
+                                column_index,
+                            )
+                            self._generate_button_code(
+                                button_class,
+                                button_args,
+                                emitter,
+                            )
+
+    def generate_code(
+        self,
+        graph: "ComponentGraph | None" = None,
+        emitter: CodeEmitter | None = None,
+    ) -> str:
+        """Generates the callback handlers of the buttons."""
+        graph = self.parent_component._get_graph(graph)
+        emitter = emitter or CodeEmitter()
+
+        for row_index, row in enumerate(self.buttons):
+            for column_index, cell in enumerate(row):
+                self._generate_callback_handlers(
                     cell,
+                    row_index,
+                    column_index,
+                    graph,
+                    emitter,
                 )
-                base_code.extend(cell_base_code)
-                callback_code.extend(cell_callback_code)
-
-                button_args = self._generate_button_args(cell)
-                row_buttons.append(
-                    self._generate_button_code(button_class, button_args),
-                )
-
-            keyboard_rows.append("[\n" + "".join(row_buttons) + "\n]")
-
-        keyboard_buttons = "[\n" + ",\n".join(keyboard_rows) + "\n]"
-        keyboard = f"{keyword_class}({variable_name} = {keyboard_buttons})"
 
-        callback_code.append("\n\n")
-        base_code.extend(callback_code)
-        return keyboard, "\n".join(base_code)
+        return emitter.render()
 
 
 class SetData(Component):
@@ -447,25 +521,26 @@ class SetData(Component):
     def required_fields(self) -> list:
         return ["key", "data"]
 
-    def generate_code(self) -> str:
-        underlying_object: SetData = (
-            self.component_content_type.model_class().objects.get(pk=self.pk)
-        )
-
-        code = [
+    def generate_code(
+        self,
+        graph: "ComponentGraph | None" = None,
+        emitter: CodeEmitter | None = None,
+    ) -> str:
+        graph = self._get_graph(graph)
+        emitter = emitter or CodeEmitter()
+        underlying_object: SetData = graph.get(self.pk)
+
+        emitter.separate()
+        with emitter.block(
             f"async def {self.code_function_name}(message: Message, **kwargs):",
-            f"    if message.from_user.id not in data_dict:",
-            "        data_dict[message.from_user.id] = dict()   ",
-            f"    data_dict[message.from_user.id]['{underlying_object.key}'] = message{underlying_object.data}",
-        ]
+        ):
+            emitter.line(
+                f"await data_store.set(message.from_user.id, {underlying_object.key!r}, message{underlying_object.data})",
+            )
 
-        for next_component in underlying_object.next_component.all():
-            next_component = (
-                next_component.component_content_type.model_class().objects.get(
-                    pk=next_component.pk,
+            for next_component in graph.next_components(underlying_object):
+                emitter.line(
+                    f"await {next_component.code_function_name}(message, **kwargs)",
                 )
-            )
-            code.append(
-                f"    await {next_component.code_function_name}(message, **kwargs)",
-            )
-        return "\n".join(code)
+
+        return emitter.render()
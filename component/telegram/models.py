@@ -1,5 +1,5 @@
 import re
-from typing import List
+from typing import TYPE_CHECKING, List
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -9,6 +9,14 @@ from django.db import models
 from django.db.models import Q
 from django.forms.models import model_to_dict
 
+from component.emitter import CodeEmitter
+
+if TYPE_CHECKING:
+    from component.graph import ComponentGraph
+
+# parameters written as a python f-string, e.g. f"{input_data.text}"
+F_STRING_LITERAL = re.compile(r"f(['\"]).*\1", re.DOTALL)
+
 
 class Component(models.Model):
     class ComponentType(models.TextChoices):
@@ -75,9 +83,15 @@ class Component(models.Model):
                 if file_instance and hasattr(file_instance, "url"):
                     full_url = f"{settings.SITE_URL}{file_instance.url}"
                     file_params = f"{field.name}='{full_url}'"
-                    setattr(underlying_object, field.name, None)
         return file_params
 
+    def _get_graph(self, graph: "ComponentGraph | None") -> "ComponentGraph":
+        if graph is None:
+            from component.graph import ComponentGraph
+
+            graph = ComponentGraph.load(self.bot_id)
+        return graph
+
     def _get_method_name(self, class_name: str) -> str:
         method = ""
         for c in class_name:
@@ -86,6 +100,19 @@ class Component(models.Model):
             method += c.lower()
         return method.lstrip("_")
 
+    def _format_string_param(self, value: str) -> str:
+        """
+        The f-string literal of a text parameter, the placeholders in it are its only
+        replacement fields. Values written as an f-string literal are kept as they are.
+        """
+        if F_STRING_LITERAL.fullmatch(value):
+            return value
+        # braces and quotes of the text are escaped before the placeholders add theirs
+        value = value.replace("{", "{{").replace("}", "}}")
+        value = self.replace_placeholders(value)
+        value = re.sub(r"\$\.(\w+(\.\w+)*)", r"{input_data.\1}", value)
+        return f"f{value!r}"
+
     def _get_component_params(
         self,
         underlying_object,
@@ -108,17 +135,20 @@ class Component(models.Model):
             "position_y",
         }
 
+        # file fields are passed by url through file_params
+        excluded_fields.update(
+            field.name
+            for field in underlying_object._meta.get_fields()
+            if isinstance(field, models.FileField)
+        )
+
         component_data = model_to_dict(underlying_object, exclude=excluded_fields)
         param_strings = []
 
         for k, v in component_data.items():
             if v:
                 if isinstance(v, str):
-                    v = self.replace_placeholders(v)
-                    v = re.sub(r"\$\.(\w+(\.\w+)*)", r"{input_data.\1}", v)
-                    param_strings.append(
-                        f"{k}=f'''{v}'''" if not v.startswith("f") else f"{k}={v}",
-                    )
+                    param_strings.append(f"{k}={self._format_string_param(v)}")
                 else:
                     param_strings.append(f"{k}={v}")
 
@@ -129,51 +159,58 @@ class Component(models.Model):
 
         return ", ".join(param_strings)
 
-    def generate_code(self) -> str:
+    def generate_code(
+        self,
+        graph: "ComponentGraph | None" = None,
+        emitter: CodeEmitter | None = None,
+    ) -> str:
         if self.component_type != Component.ComponentType.TELEGRAM:
             raise NotImplementedError
 
-        underlying_object = self.component_content_type.model_class().objects.get(
-            pk=self.pk,
-        )
+        graph = self._get_graph(graph)
+        emitter = emitter or CodeEmitter()
+        underlying_object = graph.get(self.pk)
         file_params = self._get_file_params(underlying_object)
         method = self._get_method_name(underlying_object.__class__.__name__)
+        markup = graph.markup(underlying_object)
 
-        code = [
+        emitter.separate()
+        with emitter.block(
             f"async def {underlying_object.code_function_name}(input_data: Message, **kwargs):",
-        ]
-
-        keyboard = None
-        callback_code = ""
-        # Check if markup exists before accessing it
-        if hasattr(underlying_object, "markup") and underlying_object.markup:
-            markup = underlying_object.markup
-            keyboard, callback_code = markup.generate_code()
-            code.append(f"    keyboard = {keyboard}")
-        # Generate parameters and method call
-        params_str = self._get_component_params(
-            underlying_object,
-            keyboard,
-            file_params,
-        )
-
-        code.append(f"    await bot.{method}({params_str})")
+        ):
+            if markup:
+                markup.generate_keyboard(emitter)
+            # Generate parameters and method call
+            params_str = self._get_component_params(
+                underlying_object,
+                markup,
+                file_params,
+            )
+            if "user_data.get(" in params_str:
+                # the placeholders of the user are filled from a single read
+                emitter.line(
+                    "user_data = await data_store.get(input_data.from_user.id)",
+                )
+            emitter.line(f"await bot.{method}({params_str})")
 
-        # Handle next components
-        for next_component in underlying_object.next_component.all():
-            next_component = (
-                next_component.component_content_type.model_class().objects.get(
-                    pk=next_component.pk,
+            # Handle next components
+            for next_component in graph.next_components(underlying_object):
+                emitter.line(
+                    f"await {next_component.code_function_name}(input_data, **kwargs)",
                 )
-            )
-            code.append(
-                f"    await {next_component.code_function_name}(input_data, **kwargs)",
-            )
 
-        new_code = "\n".join(code)
-        new_code += "\n\n" + callback_code
+        if markup:
+            markup.generate_code(graph, emitter)
+
+        return emitter.render()
 
-        return new_code
+    def get_linked_components(self, graph: "ComponentGraph") -> List["Component"]:
+        """Components whose functions are called from this component's code."""
+        linked = list(graph.next_components(self))
+        markup = graph.markup(self)
+        if markup:
+            linked.extend(markup.get_next_components(graph))
+        return linked
 
     def get_all_next_components(self) -> List["Component"]:
         ans = {}
@@ -191,9 +228,7 @@ class Component(models.Model):
         pattern = r"\$\[([a-zA-Z0-9_]+)\]"
         return re.sub(
             pattern,
-            lambda match: '{data_dict.get(input_data.from_user.id, dict()).get("'
-            + match.group(1)
-            + '")}',
+            lambda match: '{user_data.get("' + match.group(1) + '")}',
             text,
         )
 
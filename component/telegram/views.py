@@ -1,7 +1,10 @@
-from django.db.models import QuerySet
+from django.db.models import Model, QuerySet
+from rest_framework.serializers import BaseSerializer
 from rest_framework.viewsets import ModelViewSet
 
+from bot.models import Bot
 from bot.permissions import IsBotOwner
+from component.cache import invalidate_snippets
 from component.telegram.serializers import *
 from iam.permissions import IsLoginedPermission
 
@@ -15,6 +18,33 @@ class ModelViewSetCustom(ModelViewSet):
     def get_queryset(self) -> QuerySet:
         return super().get_queryset().filter(bot=self.kwargs.get("bot"))
 
+    def get_affected_components(self, instance: Model) -> list:
+        """Components whose generated code depends on the given instance."""
+        return [instance.pk, instance.previous_component_id]
+
+    def get_bot_id(self, instance: Model) -> int:
+        """The bot whose code depends on the given instance."""
+        return instance.bot_id
+
+    def perform_create(self, serializer: BaseSerializer) -> None:
+        super().perform_create(serializer)
+        invalidate_snippets(self.get_affected_components(serializer.instance))
+        Bot.bump_version(self.get_bot_id(serializer.instance))
+
+    def perform_update(self, serializer: BaseSerializer) -> None:
+        affected_components = self.get_affected_components(serializer.instance)
+        super().perform_update(serializer)
+        invalidate_snippets(
+            affected_components + self.get_affected_components(serializer.instance),
+        )
+        Bot.bump_version(self.get_bot_id(serializer.instance))
+
+    def perform_destroy(self, instance: Model) -> None:
+        bot_id = self.get_bot_id(instance)
+        invalidate_snippets(self.get_affected_components(instance))
+        super().perform_destroy(instance)
+        Bot.bump_version(bot_id)
+
 
 class SendMessageViewSet(ModelViewSetCustom):
     permission_classes = [IsLoginedPermission, IsBotOwner]
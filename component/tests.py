@@ -1,3 +1,50 @@
-from django.test import TestCase
+import ast
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from component.emitter import CodeEmitter
+from component.models import CodeComponent
+
+
+class CodeEmitterTest(SimpleTestCase):
+
+    def test_blocks_are_well_formed(self):
+        emitter = CodeEmitter()
+        emitter.separate()
+        with emitter.block("async def first():"):
+            pass
+        emitter.separate()
+        with emitter.block("async def second():"):
+            with emitter.block("if True:"):
+                emitter.line("x = '''multi\nline'''")
+
+        self.assertEqual(
+            emitter.render(),
+            "async def first():\n"
+            "    pass\n"
+            "\n"
+            "\n"
+            "async def second():\n"
+            "    if True:\n"
+            "        x = '''multi\nline'''",
+        )
+
+    def test_code_component_indents_every_line(self):
+        component = CodeComponent(
+            id=1,
+            code="for i in range(3):\n    print(i)\nprint('done')",
+        )
+        code = component.generate_code()
+
+        ast.parse(code)
+        self.assertIn(
+            "    for i in range(3):\n        print(i)\n    print('done')",
+            code,
+        )
+
+    def test_code_component_with_syntax_error(self):
+        component = CodeComponent(id=1, code="print('unterminated")
+        code = component.generate_code()
+
+        ast.parse(code)
+        self.assertIn("    # print('unterminated", code)
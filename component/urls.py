@@ -25,7 +25,7 @@ router.register(r"markup", MarkupSet, basename="markup")
 urlpatterns = (
     [
         path("content-type/", ContentTypeListView.as_view(), name="contenttypes"),
-        path("schema/", SchemaListView.as_view(), name="contenttypes"),
+        path("schema/", SchemaListView.as_view(), name="schema"),
     ]
     + telegram_urls
     + router.urls
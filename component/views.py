@@ -1,7 +1,11 @@
 from django.db.models import QuerySet
+from django.utils.cache import get_conditional_response
 from drf_spectacular.utils import OpenApiExample, extend_schema
 from rest_framework.generics import ListAPIView
+from rest_framework.request import Request
+from rest_framework.response import Response
 
+from bot.models import Bot
 from bot.permissions import IsBotOwner
 from component.serializers import *
 from component.telegram.views import ModelViewSetCustom
@@ -54,6 +58,25 @@ class SchemaListView(ListAPIView):
     def get_queryset(self) -> QuerySet:
         return super().get_queryset().filter(bot=self.kwargs.get("bot"))
 
+    def list(self, request: Request, *args, **kwargs) -> Response:
+        # the schema only changes with the bot version, polls of an unchanged
+        # schema skip the components queries and the serializer
+        version = (
+            Bot.objects.filter(pk=self.kwargs.get("bot"))
+            .values_list("version", flat=True)
+            .first()
+        )
+        etag = f'"{version}"'
+        # If-None-Match may list several tags, weakened ones of gzipped responses
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            not_modified["ETag"] = etag
+            return not_modified
+
+        response = super().list(request, *args, **kwargs)
+        response["ETag"] = etag
+        return response
+
 
 @extend_schema(
     examples=[
@@ -87,3 +110,9 @@ class MarkupSet(ModelViewSetCustom):
             .get_queryset()
             .filter(parent_component__bot=self.kwargs.get("bot"))
         )
+
+    def get_affected_components(self, instance: Markup) -> list:
+        return [instance.parent_component_id]
+
+    def get_bot_id(self, instance: Markup) -> int:
+        return instance.parent_component.bot_id
@@ -192,6 +192,80 @@ STATIC_CACHE_PATHS = env("STATIC_CACHE_PATHS", default="/api-doc/schema/").split
 BALE_API_URL = env("BALE_API_URL", default="https://tapi.bale.ai")
 SITE_URL = env("SITE_URL", default="http://localhost:8000")
 
+# Generated bots runtime, one of bot.runtime.RUNTIMES
+BOT_RUNTIME = env("BOT_RUNTIME", default="polling")
+# where bots keep FSM states and user data, one of bot.runtime.STORAGES, "redis"
+# keeps them at BOT_REDIS_URL across restarts and deploys
+BOT_STORAGE = env("BOT_STORAGE", default="redis")
+# storage of downloaded bots, they run on their own away from BOT_REDIS_URL
+BOT_DOWNLOAD_STORAGE = env("BOT_DOWNLOAD_STORAGE", default="memory")
+# seconds user data and states are kept after they were last set, with "redis"
+BOT_USER_DATA_TTL = env.int("BOT_USER_DATA_TTL", default=60 * 60 * 24 * 30)
+# users kept in memory at most, with "memory"
+BOT_USER_DATA_MAX_USERS = env.int("BOT_USER_DATA_MAX_USERS", default=10000)
+BOT_USER_DATA_MAX_KEYS = env.int("BOT_USER_DATA_MAX_KEYS", default=100)
+BOT_USER_DATA_MAX_VALUE_SIZE = env.int("BOT_USER_DATA_MAX_VALUE_SIZE", default=4096)
+# image with the dependencies of the generated bots, every bot image is built on it
+BOT_RUNTIME_IMAGE = env("BOT_RUNTIME_IMAGE", default="nocodi-runtime")
+# "image" builds an image per deploy, "reload" copies the code into the running
+# container of the runtime image and restarts the bot process in place, "shared"
+# runs the bot in a host process shared with other bots. Bots on a shared host are
+# not isolated from each other, bots with code components are deployed as images
+BOT_DEPLOY_MODE = env("BOT_DEPLOY_MODE", default="image")
+# seconds a new bot container has to get ready before the deploy is rolled back
+BOT_READY_TIMEOUT = env.int("BOT_READY_TIMEOUT", default=60)
+BOT_HOST_COUNT = env.int("BOT_HOST_COUNT", default=4)
+BOT_HOST_CAPACITY = env.int("BOT_HOST_CAPACITY", default=500)
+BOT_HOST_MEM_LIMIT = env("BOT_HOST_MEM_LIMIT", default="2g")
+# webhook updates are posted to the ingress, which routes them to the bots over the
+# docker network of the bots, BOT_WEBHOOK_BASE_URL has to be proxied to its port
+BOT_WEBHOOK_BASE_URL = env("BOT_WEBHOOK_BASE_URL", default=f"{SITE_URL}/bot-webhook")
+BOT_INGRESS_PORT = env.int("BOT_INGRESS_PORT", default=8443)
+BOT_NETWORK = env("BOT_NETWORK", default="nocodi-bots")
+# lines of bot logs returned by default and at most by one request
+BOT_LOG_TAIL = env.int("BOT_LOG_TAIL", default=200)
+BOT_LOG_MAX_LINES = env.int("BOT_LOG_MAX_LINES", default=5000)
+# streamed logs are polled for new lines, streams end and are resumed by the client
+# with Last-Event-ID. A stream holds its worker for the whole timeout, so it is kept
+# below the gunicorn --timeout and streaming needs a threaded or async worker class
+BOT_LOG_POLL_INTERVAL = env.float("BOT_LOG_POLL_INTERVAL", default=1.0)
+BOT_LOG_STREAM_TIMEOUT = env.int("BOT_LOG_STREAM_TIMEOUT", default=20)
+
+# Code generation
+CODEGEN_CACHE_TTL = env.int("CODEGEN_CACHE_TTL", default=60 * 60 * 24 * 7)
+# lint every generated snippet with black, off by default to keep it out of requests
+CODEGEN_BLACK_FORMAT = env.bool("CODEGEN_BLACK_FORMAT", default=False)
+# generated bot files are kept for downloads and deploys of an unchanged bot
+CODEGEN_ARTIFACT_TTL = env.int("CODEGEN_ARTIFACT_TTL", default=60 * 60 * 24)
+CODEGEN_PENDING_TTL = env.int("CODEGEN_PENDING_TTL", default=60 * 5)
+# processes generating the triggers of large bots in parallel, below 2 it is disabled.
+# Celery prefork workers can not start them and generate sequentially, run them with
+# --pool=threads or solo to generate in parallel from tasks
+CODEGEN_WORKERS = env.int("CODEGEN_WORKERS", default=0)
+CODEGEN_PARALLEL_MIN_TRIGGERS = env.int("CODEGEN_PARALLEL_MIN_TRIGGERS", default=50)
+
+# Docker hosts bots are deployed to, the environment's docker host when empty
+DOCKER_HOSTS = env.list("DOCKER_HOSTS", default=[])
+DOCKER_TIMEOUT = env.int("DOCKER_TIMEOUT", default=60)
+DOCKER_MAX_POOL_SIZE = env.int("DOCKER_MAX_POOL_SIZE", default=10)
+DOCKER_HEALTHCHECK_INTERVAL = env.int("DOCKER_HEALTHCHECK_INTERVAL", default=30)
+
+# Deploy scheduling
+DEPLOY_MAX_CONCURRENT_BUILDS = env.int("DEPLOY_MAX_CONCURRENT_BUILDS", default=2)
+DEPLOY_BUILD_TIMEOUT = env.int("DEPLOY_BUILD_TIMEOUT", default=60 * 10)
+DEPLOY_BUILD_WAIT_TIMEOUT = env.int("DEPLOY_BUILD_WAIT_TIMEOUT", default=60 * 10)
+DEPLOY_PENDING_TTL = env.int("DEPLOY_PENDING_TTL", default=60 * 30)
+DEPLOY_LOCK_TIMEOUT = env.int("DEPLOY_LOCK_TIMEOUT", default=60 * 15)
+DEPLOYMENT_HISTORY_LIMIT = env.int("DEPLOYMENT_HISTORY_LIMIT", default=50)
+
+# Update gateway, bots on the "stream" runtime consume redis streams the gateway
+# fills by polling Bale for all of them. Bots reach this redis, it is not the one of
+# the app which holds the celery broker and the code of every bot with its token
+BOT_REDIS_URL = env("BOT_REDIS_URL", default="redis://bot-redis:6379/0")
+UPDATES_STREAM_MAXLEN = env.int("UPDATES_STREAM_MAXLEN", default=10000)
+# bots with this many unhandled updates are not polled until they catch up
+UPDATES_MAX_BACKLOG = env.int("UPDATES_MAX_BACKLOG", default=1000)
+
 # Celery Configuration
 CELERY_BROKER_URL = f'redis://{env("REDIS_HOST", default="redis")}:{env("REDIS_PORT", default="6379")}/0'
 CELERY_RESULT_BACKEND = f'redis://{env("REDIS_HOST", default="redis")}:{env("REDIS_PORT", default="6379")}/0'
@@ -199,6 +273,8 @@ CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = TIME_ZONE
+# tests run the tasks in process instead of sending them to a worker
+CELERY_TASK_ALWAYS_EAGER = env.bool("CELERY_TASK_ALWAYS_EAGER", default=TESTING)
 
 # Import Celery app
 from .celery import app as celery_app
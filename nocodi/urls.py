@@ -25,9 +25,16 @@ from drf_spectacular.views import (
     SpectacularSwaggerView,
 )
 
+from bot.views import DeployMetricsView
 from nocodi.views import LivenessView
 
 urlpatterns = [
+    # metrics of every user, served next to the admin to its staff
+    path(
+        "admin/deploy-metrics/",
+        DeployMetricsView.as_view(),
+        name="deploy-metrics",
+    ),
     path("admin/", admin.site.urls),
     path("liveness/", LivenessView.as_view(), name="liveness"),
     path("api-doc/schema/", SpectacularAPIView.as_view(), name="schema"),
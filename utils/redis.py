@@ -5,3 +5,6 @@ redis_client = Redis(
     host=settings.REDIS_HOST,
     port=settings.REDIS_PORT,
 )
+
+# redis the bots and the update gateway keep their streams and user data in
+bot_redis_client = Redis.from_url(settings.BOT_REDIS_URL)